@@ -0,0 +1,174 @@
+import logging
+import os
+from datetime import date, datetime, timedelta
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Год считается закрытым спустя столько дней после его окончания
+ARCHIVE_GRACE_DAYS = int(os.getenv("ARCHIVE_GRACE_DAYS", "31"))
+# Больше архивов к соединению не подключаем: лимит SQLite — 10 вместе с temp
+ATTACH_LIMIT = 8
+# Инкрементальный VACUUM освобождает страницы порциями, не держа блокировку подолгу
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "1000"))
+
+RECORD_COLUMNS = (
+    "id", "user_id", "username", "date", "entry_time", "exit_time", "vacation",
+    "entry_ts", "exit_ts", "auto_closed", "worked_minutes",
+)
+LEDGER_COLUMNS = ("id", "user_id", "day", "kind", "minutes", "accrued_total")
+
+# В архиве worked_minutes — обычный столбец, первичные ключи те же, что в
+# рабочей базе: повторный перенос того же года просто перезаписывает строки
+ARCHIVE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS arc.records (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER, username TEXT, date TEXT, entry_time TEXT, exit_time TEXT,
+        vacation INTEGER, entry_ts INTEGER, exit_ts INTEGER,
+        auto_closed INTEGER, worked_minutes INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS arc.ix_records_user_date ON records (user_id, date)",
+    """
+    CREATE TABLE IF NOT EXISTS arc.debt_ledger (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER, day TEXT, kind TEXT, minutes INTEGER, accrued_total INTEGER
+    )
+    """,
+)
+
+# Погашенные начисления и погашения года; непогашенный долг остаётся в рабочей базе
+SETTLED_LEDGER = """
+    day BETWEEN ? AND ? AND (kind = 'payoff' OR accrued_total <= (
+        SELECT paid FROM main.debt_balance b WHERE b.user_id = debt_ledger.user_id
+    ))
+"""
+
+
+def archive_path(archive_dir, year):
+    return os.path.join(archive_dir, f"records-{year}.sqlite")
+
+
+def closed_years(conn, today=None, grace_days=ARCHIVE_GRACE_DAYS):
+    """Годы с отметками в рабочей базе, которые уже можно переносить."""
+    today = today or date.today()
+    last_closed = (today - timedelta(days=grace_days)).year - 1
+    rows = conn.execute("""
+        SELECT DISTINCT substr(date, 1, 4) FROM records WHERE date < ? ORDER BY 1
+    """, (f"{last_closed + 1}-01-01",)).fetchall()
+    return [row[0] for row in rows]
+
+
+def _transaction(conn, fn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return result
+
+
+def archive_year(conn, archive_dir, year):
+    """Переносит отметки года и погашенный долг в архивный файл.
+
+    conn — соединение с рабочей базой вне транзакции. В режиме WAL
+    транзакция над двумя файлами атомарна только для каждого по
+    отдельности, поэтому сначала коммитится копия в архив и лишь потом
+    удаление из рабочей базы. После сбоя между ними строки есть в обоих
+    файлах, а повторный перенос перезаписывает их по тем же id.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    path = archive_path(archive_dir, year)
+    params = (f"{year}-01-01", f"{year}-12-31")
+    records = ", ".join(RECORD_COLUMNS)
+    ledger = ", ".join(LEDGER_COLUMNS)
+
+    def copy():
+        for statement in ARCHIVE_SCHEMA:
+            conn.execute(statement)
+        moved = conn.execute(f"""
+            INSERT OR REPLACE INTO arc.records ({records})
+            SELECT {records} FROM main.records WHERE date BETWEEN ? AND ?
+        """, params).rowcount
+        settled = conn.execute(f"""
+            INSERT OR REPLACE INTO arc.debt_ledger ({ledger})
+            SELECT {ledger} FROM main.debt_ledger WHERE {SETTLED_LEDGER}
+        """, params).rowcount
+        return moved, settled
+
+    def purge():
+        # Удаляем ровно то, что уже лежит в архиве
+        conn.execute("""
+            DELETE FROM main.records WHERE date BETWEEN ? AND ? AND id IN (SELECT id FROM arc.records)
+        """, params)
+        conn.execute("""
+            DELETE FROM main.debt_ledger WHERE day BETWEEN ? AND ? AND id IN (SELECT id FROM arc.debt_ledger)
+        """, params)
+        # Дневные сводки восстановимы из архива, месячные остаются для аналитики
+        conn.execute("DELETE FROM main.daily_stats WHERE day BETWEEN ? AND ?", params)
+        conn.execute("""
+            INSERT INTO main.archived_years (year, path, archived_at) VALUES (?, ?, ?)
+            ON CONFLICT (year) DO UPDATE SET path = excluded.path, archived_at = excluded.archived_at
+        """, (year, path, datetime.now().isoformat(timespec="seconds")))
+
+    conn.execute("ATTACH DATABASE ? AS arc", (path,))
+    try:
+        moved, settled = _transaction(conn, copy)
+        _transaction(conn, purge)
+    finally:
+        conn.execute("DETACH DATABASE arc")
+    logging.info(f"[Архив] {year}: отметок {moved}, записей долга {settled} → {path}")
+    return moved, settled
+
+
+def archived(conn):
+    return conn.execute("SELECT year, path FROM archived_years ORDER BY year DESC").fetchall()
+
+
+def attach(conn, archives):
+    """Подключает архивы только на чтение и пересоздаёт представления *_all.
+
+    records_all и debt_ledger_all объединяют рабочую базу с архивами; без
+    архивов это просто рабочие таблицы. Нужен connect(..., uri=True).
+    """
+    for (name,) in conn.execute("SELECT name FROM pragma_database_list WHERE name LIKE 'y____'").fetchall():
+        conn.execute(f"DETACH DATABASE {name}")
+    attached = []
+    for year, path in archives[:ATTACH_LIMIT]:
+        if os.path.exists(path):
+            # year — четыре цифры из archived_years, имя схемы параметром не передать
+            conn.execute(f"ATTACH DATABASE ? AS y{year}", (f"file:{os.path.abspath(path)}?mode=ro",))
+            attached.append(f"y{year}")
+    records = ", ".join(RECORD_COLUMNS)
+    ledger = ", ".join(LEDGER_COLUMNS)
+    conn.execute("DROP VIEW IF EXISTS temp.records_all")
+    conn.execute("DROP VIEW IF EXISTS temp.debt_ledger_all")
+    conn.execute("CREATE TEMP VIEW records_all AS " + " UNION ALL ".join(
+        [f"SELECT {records} FROM main.records"] + [f"SELECT {records} FROM {name}.records" for name in attached]))
+    conn.execute("CREATE TEMP VIEW debt_ledger_all AS " + " UNION ALL ".join(
+        [f"SELECT {ledger} FROM main.debt_ledger"] + [f"SELECT {ledger} FROM {name}.debt_ledger" for name in attached]))
+    return attached
+
+
+def enable_incremental_vacuum(conn):
+    """Переводит существующую базу на auto_vacuum=INCREMENTAL (один полный VACUUM)."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    logging.info("[Архив] База переведена на auto_vacuum=INCREMENTAL")
+    return True
+
+
+def incremental_vacuum(conn, pages=VACUUM_PAGES):
+    """Возвращает свободные страницы файлу порциями по pages. Возвращает число страниц."""
+    start = free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    while free:
+        # execute() делает один шаг прагмы — одну страницу; executescript доводит до конца
+        conn.executescript(f"PRAGMA incremental_vacuum({pages});")
+        left = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if left >= free:
+            break
+        free = left
+    return start - free
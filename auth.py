@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+DENIED_TEXT = "⛔ У вас нет доступа к этому боту."
+# Отметка в job_runs: список из AUTHORIZED_IDS уже переносился в базу
+SEED_MARK = "seed_authorized_users"
+# Как часто процесс перечитывает список, который могли изменить другие процессы
+AUTH_RELOAD_SECONDS = int(os.getenv("AUTH_RELOAD_SECONDS", "30"))
+
+
+def parse_ids(text):
+    return [int(part) for part in text.replace(",", " ").split() if part.strip().lstrip("-").isdigit()]
+
+
+class Authorization:
+    """Доступ к боту: таблица authorized_users, в памяти — frozenset.
+
+    Проверка — один lookup в множестве без обращения к базе. После
+    изменения множество перечитывается из базы и подменяется целиком,
+    так что обработчики видят либо старый, либо новый состав. При общей
+    базе /allow и /deny могли выполниться в другом процессе — тогда список
+    перечитывается по таймеру (watch).
+    """
+
+    def __init__(self, storage, owner_id, seed_ids=()):
+        self.storage = storage
+        self.owner_id = owner_id
+        self.seed_ids = list(seed_ids)
+        self.users = frozenset([owner_id])
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    async def load(self):
+        if SEED_MARK not in await self.storage.get_job_runs():
+            # Первый запуск: переносим AUTHORIZED_IDS в базу один раз. Дальше
+            # пустая таблица — это решение владельца, а не повод для повтора
+            if self.seed_ids and not await self.storage.get_authorized_users():
+                added = await self.storage.add_authorized_users(self.seed_ids)
+                logging.info(f"[Доступ] Из AUTHORIZED_IDS добавлено пользователей: {added}")
+            await self.storage.save_job_run(SEED_MARK, datetime.now().isoformat(timespec="seconds"))
+        await self.reload()
+
+    async def reload(self):
+        ids = await self.storage.get_authorized_users()
+        self.users = frozenset(ids) | {self.owner_id}
+
+    async def watch(self, interval=AUTH_RELOAD_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload()
+            except Exception:
+                logging.exception("[Доступ] Не удалось перечитать список доступа")
+
+    async def add(self, user_ids):
+        added = await self.storage.add_authorized_users(user_ids)
+        await self.reload()
+        return added
+
+    async def remove(self, user_ids):
+        removed = await self.storage.remove_authorized_users(user_ids)
+        await self.reload()
+        return removed
+
+
+class AuthMiddleware(BaseMiddleware):
+    """Отсекает чужие обновления до фильтров, обработчиков и запросов к базе."""
+
+    def __init__(self, authorization):
+        super().__init__()
+        self.authorization = authorization
+
+    async def on_pre_process_update(self, update, data):
+        event = update.message or update.edited_message or update.callback_query
+        user = getattr(event, "from_user", None)
+        if user is not None and user.id in self.authorization.users:
+            return
+        # Отвечаем только на /start, остальное молча отбрасываем
+        if update.message and update.message.text and update.message.text.startswith("/start"):
+            await update.message.answer(DENIED_TEXT)
+        raise CancelHandler()
@@ -0,0 +1,155 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен, по умолчанию gzip
+    zstandard = None
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_COMPRESSION = os.getenv("BACKUP_COMPRESSION", "gzip")
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY", "7"))
+BACKUP_KEEP_WEEKLY = int(os.getenv("BACKUP_KEEP_WEEKLY", "4"))
+BACKUP_KEEP_MONTHLY = int(os.getenv("BACKUP_KEEP_MONTHLY", "12"))
+
+# Копируем по PAGES_PER_STEP страниц и отпускаем базу на PAUSE секунд
+PAGES_PER_STEP = 256
+PAUSE = 0.002
+CHUNK_SIZE = 1024 * 1024
+NAME_FORMAT = "data-%Y%m%d-%H%M%S"
+# Копии архивов по этому шаблону не разбираются и в ротацию не попадают
+ARCHIVE_NAME_FORMAT = "records-{year}-%Y%m%d-%H%M%S"
+
+BackupInfo = namedtuple("BackupInfo", "path size sha256 duration")
+
+
+def _open_compressed(path, compression):
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Для BACKUP_COMPRESSION=zstd нужен пакет zstandard")
+        return zstandard.ZstdCompressor(level=10).stream_writer(open(path, "wb"))
+    return gzip.open(path, "wb", compresslevel=6)
+
+
+def _extension(compression):
+    return ".sqlite.zst" if compression == "zstd" else ".sqlite.gz"
+
+
+def _snapshot(db_path, tmp_path):
+    # Онлайн-бэкап SQLite: писатели продолжают работать между шагами
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst, pages=PAGES_PER_STEP, progress=lambda status, remaining, total: time.sleep(PAUSE))
+    finally:
+        dst.close()
+        src.close()
+
+
+def _compress(tmp_path, out_path, compression):
+    # Сжимаем потоком и одновременно считаем контрольную сумму исходного снимка
+    digest = hashlib.sha256()
+    with open(tmp_path, "rb") as src, _open_compressed(out_path, compression) as dst:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            dst.write(chunk)
+    return digest.hexdigest()
+
+
+def make_backup(db_path, backup_dir=BACKUP_DIR, compression=BACKUP_COMPRESSION, now=None, name_format=NAME_FORMAT):
+    started = time.monotonic()
+    now = now or datetime.now()
+    os.makedirs(backup_dir, exist_ok=True)
+    name = now.strftime(name_format)
+    tmp_path = os.path.join(backup_dir, name + ".tmp")
+    out_path = os.path.join(backup_dir, name + _extension(compression))
+    try:
+        _snapshot(db_path, tmp_path)
+        sha256 = _compress(tmp_path, out_path, compression)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    with open(out_path + ".sha256", "w") as f:
+        f.write(f"{sha256}  {name}.sqlite\n")
+
+    rotate(backup_dir, now)
+    return BackupInfo(out_path, os.path.getsize(out_path), sha256, time.monotonic() - started)
+
+
+def _list_backups(backup_dir):
+    result = []
+    for filename in os.listdir(backup_dir):
+        if not filename.endswith((".sqlite.gz", ".sqlite.zst")):
+            continue
+        try:
+            created = datetime.strptime(filename.split(".")[0], NAME_FORMAT)
+        except ValueError:
+            continue
+        result.append((created, os.path.join(backup_dir, filename)))
+    result.sort(reverse=True)
+    return result
+
+
+def _generations(backups, key, count, since):
+    # Самая свежая копия в каждом периоде (день/неделя/месяц) за последние count периодов
+    keep = set()
+    seen = set()
+    for created, path in backups:
+        if created < since:
+            break
+        period = key(created)
+        if period not in seen and len(seen) < count:
+            seen.add(period)
+            keep.add(path)
+    return keep
+
+
+def rotate(backup_dir=BACKUP_DIR, now=None):
+    now = now or datetime.now()
+    backups = _list_backups(backup_dir)
+    if not backups:
+        return []
+
+    keep = {backups[0][1]}
+    keep |= _generations(backups, lambda d: d.date(), BACKUP_KEEP_DAILY,
+                         now - timedelta(days=BACKUP_KEEP_DAILY))
+    keep |= _generations(backups, lambda d: d.isocalendar()[:2], BACKUP_KEEP_WEEKLY,
+                         now - timedelta(weeks=BACKUP_KEEP_WEEKLY))
+    keep |= _generations(backups, lambda d: (d.year, d.month), BACKUP_KEEP_MONTHLY,
+                         now - timedelta(days=31 * BACKUP_KEEP_MONTHLY))
+
+    removed = []
+    for _, path in backups:
+        if path in keep:
+            continue
+        for p in (path, path + ".sha256"):
+            if os.path.exists(p):
+                os.remove(p)
+        removed.append(path)
+    if removed:
+        logging.info(f"[Бэкап] Удалено старых копий: {len(removed)}")
+    return removed
+
+
+async def create_backup(db_path, name_format=NAME_FORMAT):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: make_backup(db_path, name_format=name_format))
+
+
+def format_size(size):
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
@@ -0,0 +1,200 @@
+"""Нагрузочный прогон бота без Telegram.
+
+Генерирует базу с историей отметок, подменяет отправку запросов к API
+и прогоняет синтетические Update через Dispatcher от имени N пользователей:
+
+    python bench.py --users 300 --days 365 --rounds 3
+
+Для каждого сценария печатает пропускную способность и p50/p95/p99.
+"""
+import argparse
+import asyncio
+import calendar
+import itertools
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+SHIFT_TIMES = ("07:30", "08:30", "15:00", "16:00")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон обработчиков бота")
+    parser.add_argument("--users", type=int, default=200, help="число синтетических сотрудников")
+    parser.add_argument("--days", type=int, default=180, help="глубина истории в днях")
+    parser.add_argument("--rounds", type=int, default=3, help="повторов каждого сценария")
+    parser.add_argument("--db", default=None, help="путь к базе (по умолчанию временный файл)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def generate_history(path, users, days, seed):
+    # Рабочие дни с отметками, отпуск раз в несколько недель, сегодня пусто
+    rnd = random.Random(seed)
+    today = date.today()
+    conn = sqlite3.connect(path)
+    shifts = []
+    records = []
+    for user_id in users:
+        start = rnd.choice(SHIFT_TIMES)
+        shifts.append((user_id, start, (today - timedelta(days=days)).isoformat()))
+        hour, minute = map(int, start.split(":"))
+        for offset in range(days, 0, -1):
+            day = today - timedelta(days=offset)
+            if day.weekday() >= 5:
+                continue
+            day_ts = calendar.timegm(day.timetuple())
+            if rnd.random() < 0.04:
+                records.append((user_id, None, day.isoformat(), None, None, 1, None, None))
+                continue
+            entry = hour * 60 + minute + rnd.randint(-20, 10)
+            exit_ = entry + rnd.randint(400, 540)
+            records.append((user_id, f"user{user_id}", day.isoformat(),
+                            f"{entry // 60:02}:{entry % 60:02}:00",
+                            f"{exit_ // 60 % 24:02}:{exit_ % 60:02}:00", 0,
+                            day_ts + entry * 60, day_ts + exit_ * 60))
+    with conn:
+        conn.executemany("INSERT INTO shifts (user_id, start_time, effective_from) VALUES (?, ?, ?)", shifts)
+        conn.executemany("""
+            INSERT INTO records (user_id, username, date, entry_time, exit_time, vacation, entry_ts, exit_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, records)
+    conn.close()
+    return len(records)
+
+
+class Recorder:
+    """Подменяет Bot.request: запоминает вызовы API и отвечает как Telegram."""
+
+    def __init__(self):
+        self.calls = []
+        self.message_ids = itertools.count(1)
+
+    async def __call__(self, method, data=None, files=None, **kwargs):
+        data = data or {}
+        self.calls.append(method)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+            "text": data.get("text", ""),
+        }
+
+
+def make_update(update_ids, user_id, text):
+    from aiogram import types
+    update_id = next(update_ids)
+    return types.Update.to_object({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+            "text": text,
+        },
+    })
+
+
+def vacation_text(rnd):
+    start = date.today() + timedelta(days=rnd.randint(30, 300))
+    end = start + timedelta(days=rnd.randint(1, 21))
+    return f"{start.strftime('%d.%m')}–{end.strftime('%d.%m')}"
+
+
+async def run_scenario(dp, update_ids, users, text_for):
+    latencies = []
+
+    async def one(user_id):
+        update = make_update(update_ids, user_id, text_for(user_id))
+        started = time.perf_counter()
+        await dp.process_updates([update])
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(user_id) for user_id in users))
+    return latencies, time.perf_counter() - started
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def main(args):
+    import bot as bot_module
+    import db
+    from aiogram import Bot, Dispatcher
+
+    recorder = Recorder()
+    bot_module.bot.request = recorder
+    Bot.set_current(bot_module.bot)
+    Dispatcher.set_current(bot_module.dp)
+    await bot_module.storage.open()
+    await bot_module.authorization.load()
+
+    rnd = random.Random(args.seed)
+    users = list(range(1, args.users + 1))
+    update_ids = itertools.count(1)
+    scenarios = [
+        ("/start", lambda u: "/start"),
+        ("handle_entry", lambda u: "✅ Я на предприятии"),
+        ("report_week", lambda u: "🗓️ За неделю"),
+        ("report_month", lambda u: "📅 За месяц"),
+        ("analytics", lambda u: "📈 Аналитика"),
+        ("vacation", lambda u: vacation_text(rnd)),
+        ("handle_exit", lambda u: "🏁 Завершить день"),
+    ]
+
+    print(f"{'сценарий':<14} {'апд/с':>9} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9} {'макс мс':>9}")
+    for name, text_for in scenarios:
+        latencies = []
+        elapsed = 0.0
+        for _ in range(args.rounds):
+            round_latencies, round_elapsed = await run_scenario(bot_module.dp, update_ids, users, text_for)
+            latencies += round_latencies
+            elapsed += round_elapsed
+        ms = [x * 1000 for x in latencies]
+        print(f"{name:<14} {len(ms) / elapsed:>9.0f} {percentile(ms, 50):>9.2f} {percentile(ms, 95):>9.2f} "
+              f"{percentile(ms, 99):>9.2f} {max(ms):>9.2f}")
+
+    print(f"\nвызовов API: {len(recorder.calls)}, "
+          f"групповых коммитов: {db.db.batches} на {db.db.batched_writes} записей, "
+          f"кэш смен: {db.shift_cache.hits} попаданий / {db.shift_cache.misses} промахов")
+    await bot_module.storage.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    workdir = None
+    if args.db is None:
+        workdir = tempfile.mkdtemp(prefix="wktb-bench-")
+        args.db = os.path.join(workdir, "data.sqlite")
+
+    ids = ",".join(str(i) for i in range(1, args.users + 1))
+    os.environ["DB_PATH"] = args.db
+    os.environ.setdefault("API_TOKEN", "123456:bench-token-bench-token-bench-token")
+    os.environ.setdefault("AUTHORIZED_IDS", ids)
+    os.environ.setdefault("OWNER_ID", "1")
+    # Сценарии повторяют одни и те же нажатия, защита от двойных нажатий их бы отбросила
+    os.environ.setdefault("TAP_DEBOUNCE_MS", "0")
+    os.environ.setdefault("BACKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(args.db)), "backups"))
+
+    import db
+    import rollups
+
+    db.init_db()
+    started = time.perf_counter()
+    count = generate_history(args.db, range(1, args.users + 1), args.days, args.seed)
+    db.db.write_sync(rollups.rebuild)
+    print(f"база: {args.db}, записей: {count}, подготовка {time.perf_counter() - started:.1f} с", file=sys.stderr)
+
+    asyncio.run(main(args))
@@ -1,20 +1,49 @@
 import asyncio
 import locale
 import logging
-import sqlite3
 import os
+import time
 from datetime import datetime, timedelta, date
-from aiogram import Bot, Dispatcher, executor, types
+from aiogram import Dispatcher, executor, types
 from aiogram.dispatcher import filters
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InputFile
 
+import backup
+import auth
+import metrics
+import profiler
+import webhook
+from outbox import Outbox
+from scheduler import Scheduler
+from storage import open_storage, timestamp
+from reportcache import report_cache, split_message
+from router import TextRouter
+
 API_TOKEN = os.getenv("API_TOKEN")
-AUTHORIZED_USERS = list(map(int, os.getenv("AUTHORIZED_IDS", "").split(",")))
 OWNER_ID = int(os.getenv("OWNER_ID", "0"))  # Твой Telegram ID
+BACKUP_AT = os.getenv("BACKUP_AT", "21:00")
+RECONCILE_AT = os.getenv("RECONCILE_AT", "04:00")  # Ночная сверка незакрытых смен
+ARCHIVE_AT = os.getenv("ARCHIVE_AT", "03:30")  # Перенос прошлых лет в архив и сжатие базы
+# При нескольких процессах на общей БД фоновые задачи оставляют одному
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "1") != "0"
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling или webhook
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=API_TOKEN)
+bot = metrics.InstrumentedBot(token=API_TOKEN)
 dp = Dispatcher(bot)
+outbox = Outbox(bot)
+storage = open_storage()
+if storage.shared:
+    # Отметку могли сделать через другой процесс, а его сброс кэша сюда не дойдёт
+    report_cache.disable()
+# Начальный список доступа; дальше он ведётся командами /allow и /deny
+authorization = auth.Authorization(storage, OWNER_ID, auth.parse_ids(os.getenv("AUTHORIZED_IDS", "")))
+dp.middleware.setup(auth.AuthMiddleware(authorization))
+dp.middleware.setup(metrics.MetricsMiddleware())
+# Профилирование включается только командой /profile
+profiling = profiler.Profiler()
+dp.middleware.setup(profiler.ProfilerMiddleware(profiling))
+router = TextRouter()
 
 # Главное меню с учётом статуса смены
 def get_main_menu(on_shift):
@@ -53,73 +82,24 @@ SHIFTS = {
     "16:00": {"start": "16:00", "duration": 7.0, "evening": True},
 }
 
-def init_db():
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            username TEXT,
-            date TEXT,
-            entry_time TEXT,
-            exit_time TEXT,
-            vacation INTEGER DEFAULT 0
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS shifts (
-            user_id INTEGER,
-            start_time TEXT,
-            effective_from TEXT
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS debt (
-            user_id INTEGER,
-            day TEXT,
-            minutes INTEGER
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-init_db()
 
 @dp.message_handler(commands=["start"])
 async def start_handler(message: types.Message):
-    if not is_authorized(message.from_user.id):
-        await message.answer("⛔ У вас нет доступа к этому боту.")
-        return
-
-    if not user_has_shift(message.from_user.id):
+    if not await storage.user_has_shift(message.from_user.id):
         await ask_shift_type(message)
         return
 
-    on_shift = check_user_on_shift(message.from_user.id)
+    on_shift = await storage.check_user_on_shift(message.from_user.id)
     await message.answer("Выберите действие:", reply_markup=get_main_menu(on_shift))
 
 
-def is_authorized(user_id):
-    return user_id in AUTHORIZED_USERS
-
-
-def user_has_shift(user_id):
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM shifts WHERE user_id = ?", (user_id,))
-    result = cur.fetchone()
-    conn.close()
-    return result is not None
-
-
 async def ask_shift_type(message):
     markup = ReplyKeyboardMarkup(resize_keyboard=True)
     markup.add(KeyboardButton("🕗 Утренняя"), KeyboardButton("🌙 Вечерняя"))
     await message.answer("👋 Привет! Выбери свою смену:", reply_markup=markup)
 
 
-@dp.message_handler(lambda m: m.text in ["🕗 Утренняя", "🌙 Вечерняя"])
+@router.text("🕗 Утренняя", "🌙 Вечерняя")
 async def choose_shift_time(message: types.Message):
     user_id = message.from_user.id
     shift_type = message.text
@@ -134,49 +114,24 @@ async def choose_shift_time(message: types.Message):
     await message.answer("⏱ Укажи время начала смены:", reply_markup=markup)
 
 
-@dp.message_handler(lambda m: m.text in SHIFTS.keys())
+@router.text(*SHIFTS)
 async def save_user_shift(message: types.Message):
     user_id = message.from_user.id
     selected_time = message.text
     today = date.today().isoformat()
 
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("DELETE FROM shifts WHERE user_id = ?", (user_id,))
-    cur.execute("INSERT INTO shifts (user_id, start_time, effective_from) VALUES (?, ?, ?)",
-                (user_id, selected_time, today))
-    conn.commit()
-    conn.close()
+    await storage.save_shift(user_id, selected_time, today)
 
     await message.answer(f"✅ Смена сохранена ({selected_time}).", reply_markup=get_main_menu(False))
 
-def get_user_shift(user_id, target_date=None):
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    if target_date is None:
-        target_date = date.today().isoformat()
-    cur.execute(
-        "SELECT start_time FROM shifts WHERE user_id = ? AND effective_from <= ? ORDER BY effective_from DESC LIMIT 1",
-        (user_id, target_date))
-    row = cur.fetchone()
-    conn.close()
-    if row:
-        return SHIFTS.get(row[0])
+async def get_user_shift(user_id, target_date=None):
+    start_time = await storage.get_user_shift_time(user_id, target_date)
+    if start_time:
+        return SHIFTS.get(start_time)
     return None
 
-def check_user_on_shift(user_id):
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT 1 FROM records
-        WHERE user_id = ? AND date = ? AND exit_time IS NULL AND vacation = 0
-    """, (user_id, date.today().isoformat()))
-    result = cur.fetchone()
-    conn.close()
-    return result is not None
 
-
-@dp.message_handler(lambda m: m.text == "✅ Я на предприятии")
+@router.text("✅ Я на предприятии")
 async def handle_entry(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username
@@ -184,10 +139,11 @@ async def handle_entry(message: types.Message):
     now = datetime.now()
     now_str = now.strftime("%H:%M:%S")
 
-    shift = get_user_shift(user_id)
+    shift = await get_user_shift(user_id)
     if not shift:
         await message.answer("⚠️ Не удалось определить смену.")
         await ask_shift_type(message)
+        return
 
     entry_time = datetime.strptime(shift['start'], "%H:%M").time()
     actual_entry = datetime.combine(date.today(), now.time())
@@ -197,15 +153,14 @@ async def handle_entry(message: types.Message):
         early = 0
 
     # Сохраняем вход
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("INSERT INTO records (user_id, username, date, entry_time) VALUES (?, ?, ?, ?)",
-                (user_id, username or "", today, now_str))
-    conn.commit()
-    conn.close()
+    if not await storage.add_entry(user_id, username, today, now_str, timestamp(now)):
+        on_shift = await storage.check_user_on_shift(user_id)
+        await message.answer("⚠️ Вход за сегодня уже зарегистрирован.", reply_markup=get_main_menu(on_shift))
+        return
+    report_cache.invalidate(user_id, today)
 
     # Сообщаем про долг
-    debt = get_total_debt(user_id)
+    debt = await storage.get_total_debt(user_id)
     debt_str = ""
     if debt > 0:
         hours = debt // 60
@@ -221,73 +176,25 @@ async def handle_entry(message: types.Message):
     )
 
 
-def get_total_debt(user_id):
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("SELECT SUM(minutes) FROM debt WHERE user_id = ?", (user_id,))
-    result = cur.fetchone()
-    conn.close()
-    return result[0] if result and result[0] is not None else 0
-
-def update_debt(user_id, date_str, diff_minutes):
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("INSERT INTO debt (user_id, day, minutes) VALUES (?, ?, ?)",
-                (user_id, date_str, diff_minutes))
-    conn.commit()
-    conn.close()
-
-
-def reduce_debt(user_id, minutes_available):
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("SELECT day, minutes FROM debt WHERE user_id = ? ORDER BY day", (user_id,))
-    rows = cur.fetchall()
-    remaining = minutes_available
-
-    for day, minutes in rows:
-        if remaining <= 0:
-            break
-        to_deduct = min(remaining, minutes)
-        new_balance = minutes - to_deduct
-        if new_balance == 0:
-            cur.execute("DELETE FROM debt WHERE user_id = ? AND day = ?", (user_id, day))
-        else:
-            cur.execute("UPDATE debt SET minutes = ? WHERE user_id = ? AND day = ?", (new_balance, user_id, day))
-        remaining -= to_deduct
-
-    conn.commit()
-    conn.close()
-
-
-@dp.message_handler(lambda m: m.text == "🏁 Завершить день")
+@router.text("🏁 Завершить день")
 async def handle_exit(message: types.Message):
     user_id = message.from_user.id
-    today = date.today().isoformat()
-    now = datetime.now().time()
+    now = datetime.now()
     now_str = now.strftime("%H:%M:%S")
+    now_ts = timestamp(now)
 
-    shift = get_user_shift(user_id)
+    shift = await get_user_shift(user_id)
     if not shift:
         await message.answer("⚠️ Смена не найдена.")
         return
 
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT entry_time FROM records
-        WHERE user_id = ? AND date = ? AND exit_time IS NULL AND vacation = 0
-    """, (user_id, today))
-    row = cur.fetchone()
-
-    if not row:
+    record = await storage.get_open_record(user_id, now_ts)
+    if not record:
         await message.answer("⚠️ Вход не найден.")
-        conn.close()
         return
 
-    entry_time = datetime.strptime(row[0], "%H:%M:%S")
-    exit_time = datetime.combine(date.today(), now)
-    worked_minutes = int((exit_time - datetime.combine(date.today(), entry_time.time())).total_seconds() // 60)
+    day, entry_ts = record
+    worked_minutes = (now_ts - entry_ts) // 60
 
     required_minutes = int(shift["duration"] * 60)
     overtime = worked_minutes - required_minutes
@@ -296,240 +203,232 @@ async def handle_exit(message: types.Message):
     if shift["evening"] and overtime > 0:
         overtime = 0
 
-    if overtime < 0:
-        update_debt(user_id, today, -overtime)
-    elif overtime > 0:
-        reduce_debt(user_id, overtime)
-
-    cur.execute("""
-        UPDATE records SET exit_time = ?
-        WHERE user_id = ? AND date = ? AND exit_time IS NULL
-    """, (now_str, user_id, today))
-    conn.commit()
-    conn.close()
+    await storage.close_day(user_id, day, now_str, now_ts, overtime)
+    report_cache.invalidate(user_id, day)
 
     await message.answer(f"🏁 Выход зарегистрирован: {now_str}", reply_markup=get_main_menu(False))
 
 
-@dp.message_handler(lambda m: m.text == "📋 Больше функций")
+@router.text("📋 Больше функций")
 async def more_menu_handler(message: types.Message):
     await message.answer("Дополнительные функции:", reply_markup=more_menu)
 
-@dp.message_handler(lambda m: m.text == "⬅️ Назад")
+@router.text("⬅️ Назад")
 async def back_to_main(message: types.Message):
-    on_shift = check_user_on_shift(message.from_user.id)
+    on_shift = await storage.check_user_on_shift(message.from_user.id)
     await message.answer("Вы вернулись в главное меню.", reply_markup=get_main_menu(on_shift))
 
-@dp.message_handler(lambda m: m.text == "⚙️ Изменить смену")
+@router.text("⚙️ Изменить смену")
 async def change_shift(message: types.Message):
     await ask_shift_type(message)
 
-@dp.message_handler(lambda m: m.text == "📊 Отчёт")
+@router.text("📊 Отчёт")
 async def report_menu_handler(message: types.Message):
     await message.answer("Выберите тип отчёта:", reply_markup=report_menu)
 
 
-@dp.message_handler(lambda m: m.text == "📅 За месяц")
+def report_line(row):
+    d = date.fromisoformat(row[0]).strftime("%d.%m")
+    if row[3]:
+        return f"{d} — 🏖️ Отпуск"
+    elif row[4]:
+        return f"{d} — 🔘 Вход: {row[1]}, выход не отмечен"
+    elif row[1] and row[2]:
+        return f"{d} — 🔘 {row[1]}–{row[2]}"
+    return f"{d} — 🔘 Вход: {row[1]}"
+
+
+async def render_month_report(user_id, now, first_day):
+    rows = await storage.get_records_since(user_id, first_day.isoformat())
+    if not rows:
+        return "😕 За этот месяц пока нет данных."
+
+    total_vac = sum(1 for row in rows if row[3])
+    total_days = len(rows) - total_vac
+    lines = [f"📅 Отчёт за {now.strftime('%B')}"]
+    lines += [report_line(row) for row in rows]
+    lines.append(f"\n📊 Рабочих дней: {total_days} | Отпускных: {total_vac}")
+    return "\n".join(lines)
+
+
+async def render_week_report(user_id, monday):
+    rows = await storage.get_records_since(user_id, monday.isoformat())
+    if not rows:
+        return "😕 За эту неделю пока нет данных."
+
+    lines = ["🗓️ Отчёт за неделю:"]
+    lines += [report_line(row) for row in rows]
+    return "\n".join(lines)
+
+
+async def send_report(message, kind, first_day, render):
+    user_id = message.from_user.id
+    parts = report_cache.get(user_id, kind, first_day.isoformat())
+    if parts is None:
+        parts = split_message(await render())
+        report_cache.put(user_id, kind, first_day.isoformat(), parts)
+    for part in parts:
+        await message.answer(part)
+
+
+@router.text("📅 За месяц")
 async def report_month(message: types.Message):
     now = datetime.now()
     first_day = date(now.year, now.month, 1)
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT date, entry_time, exit_time, vacation
-        FROM records
-        WHERE user_id = ? AND date >= ?
-        ORDER BY date
-    """, (message.from_user.id, first_day.isoformat()))
-    rows = cur.fetchall()
-    conn.close()
+    await send_report(message, "month", first_day,
+                      lambda: render_month_report(message.from_user.id, now, first_day))
 
-    if not rows:
-        await message.answer("😕 За этот месяц пока нет данных.")
-        return
 
-    total_days = 0
-    total_vac = 0
-    report = f"📅 Отчёт за {now.strftime('%B')}\n"
-    for row in rows:
-        d = date.fromisoformat(row[0]).strftime("%d.%m")
-        if row[3]:
-            report += f"{d} — 🏖️ Отпуск\n"
-            total_vac += 1
-        elif row[1] and row[2]:
-            report += f"{d} — 🔘 {row[1]}–{row[2]}\n"
-            total_days += 1
-        else:
-            report += f"{d} — 🔘 Вход: {row[1]}\n"
-            total_days += 1
-
-    report += f"\n📊 Рабочих дней: {total_days} | Отпускных: {total_vac}"
-    await message.answer(report)
-
-
-@dp.message_handler(lambda m: m.text == "🗓️ За неделю")
+@router.text("🗓️ За неделю")
 async def report_week(message: types.Message):
     today = date.today()
     monday = today - timedelta(days=today.weekday())
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT date, entry_time, exit_time, vacation
-        FROM records
-        WHERE user_id = ? AND date >= ?
-        ORDER BY date
-    """, (message.from_user.id, monday.isoformat()))
-    rows = cur.fetchall()
-    conn.close()
-
-    if not rows:
-        await message.answer("😕 За эту неделю пока нет данных.")
-        return
+    await send_report(message, "week", monday,
+                      lambda: render_week_report(message.from_user.id, monday))
 
-    report = "🗓️ Отчёт за неделю:\n"
-    for row in rows:
-        d = date.fromisoformat(row[0]).strftime("%d.%m")
-        if row[3]:
-            report += f"{d} — 🏖️ Отпуск\n"
-        elif row[1] and row[2]:
-            report += f"{d} — 🔘 {row[1]}–{row[2]}\n"
-        else:
-            report += f"{d} — 🔘 Вход: {row[1]}\n"
 
-    await message.answer(report)
+MAX_VACATION_DAYS = 366
 
+def is_vacation_period(text):
+    return ("-" in text or "–" in text) and len(text) <= 25
 
-@dp.message_handler(lambda m: m.text == "🏖️ Отпуск")
+@router.text("🏖️ Отпуск")
 async def set_vacation(message: types.Message):
     await message.answer("Введите период отпуска:\nнапример: 01.07–05.07", reply_markup=cancel_menu)
 
-@dp.message_handler(lambda m: "-" in m.text and len(m.text) <= 25, state=None)
+@router.pattern(is_vacation_period)
 async def handle_vacation_period(message: types.Message):
-    try:
-        user_id = message.from_user.id
-        year = date.today().year
+    user_id = message.from_user.id
 
-        # Убираем пробелы и заменяем длинное тире
-        raw = message.text.replace(" ", "").replace("–", "-")
+    # Убираем пробелы и заменяем длинное тире
+    raw = message.text.replace(" ", "").replace("–", "-")
+    try:
         start_str, end_str = raw.split("-")
-        start_date = datetime.strptime(f"{start_str}.{year}", "%d.%m.%Y").date()
-        end_date = datetime.strptime(f"{end_str}.{year}", "%d.%m.%Y").date()
-
-        if end_date < start_date:
-            await message.answer("⚠️ Дата окончания раньше начала.")
-            return
-
-        conn = sqlite3.connect("data.sqlite")
-        cur = conn.cursor()
-
-        current = start_date
-        added = 0
-        skipped = 0
-
-        while current <= end_date:
-            cur.execute("SELECT entry_time, exit_time FROM records WHERE user_id = ? AND date = ?", (user_id, current.isoformat()))
-            row = cur.fetchone()
-            if row and (row[0] or row[1]):
-                skipped += 1  # уже есть реальные данные — не перезаписываем
-            else:
-                cur.execute("""
-                    INSERT OR REPLACE INTO records (user_id, date, vacation)
-                    VALUES (?, ?, 1)
-                """, (user_id, current.isoformat()))
-                added += 1
-            current += timedelta(days=1)
-
-        conn.commit()
-        conn.close()
-
-        if added == 0:
-            await message.answer("⚠️ Отпуск не добавлен: во всех днях уже есть данные.")
-        else:
-            await message.answer(
-                f"🏖️ Отпуск добавлен: {start_str}–{end_str}\n✅ Дней добавлено: {added}\n⏩ Пропущено (уже есть данные): {skipped}",
-                reply_markup=get_main_menu(False)
-            )
-
-    except Exception:
+        start_date, end_date = parse_vacation_period(start_str, end_str, date.today())
+    except ValueError:
         await message.answer("⚠️ Неверный формат. Пример: 01.07–05.07", reply_markup=cancel_menu)
+        return
 
+    if end_date < start_date:
+        await message.answer("⚠️ Дата окончания раньше начала.")
+        return
 
-@dp.message_handler(lambda m: m.text == "❌ Отмена")
-async def cancel_action(message: types.Message):
-    on_shift = check_user_on_shift(message.from_user.id)
-    await message.answer("❌ Отменено.", reply_markup=get_main_menu(on_shift))
+    added, skipped = await storage.add_vacation(user_id, start_date.isoformat(), end_date.isoformat())
+    if added:
+        report_cache.invalidate(user_id, start_date.isoformat(), end_date.isoformat())
 
-async def daily_backup():
-    while True:
-        now = datetime.now()
-        target_time = now.replace(hour=21, minute=0, second=0, microsecond=0)
-        if now >= target_time:
-            target_time += timedelta(days=1)
+    if added == 0:
+        await message.answer("⚠️ Отпуск не добавлен: во всех днях уже есть данные.")
+    else:
+        await message.answer(
+            f"🏖️ Отпуск добавлен: {start_str}–{end_str}\n✅ Дней добавлено: {added}\n⏩ Пропущено (уже есть данные): {skipped}",
+            reply_markup=get_main_menu(False)
+        )
 
-        wait_seconds = (target_time - now).total_seconds()
-        await asyncio.sleep(wait_seconds)
 
-        try:
-            backup_path = "backup.sqlite"
-            with open("data.sqlite", "rb") as src, open(backup_path, "wb") as dst:
-                dst.write(src.read())
+def parse_vacation_date(text, year):
+    if text.count(".") == 2:
+        return datetime.strptime(text, "%d.%m.%Y").date()
+    return datetime.strptime(f"{text}.{year}", "%d.%m.%Y").date()
 
-            if OWNER_ID:
-                await bot.send_document(OWNER_ID, InputFile(backup_path), caption="🗂 Бэкап за сегодня")
 
-        except Exception as e:
-            logging.error(f"[Бэкап] Ошибка при отправке: {e}")
+def parse_vacation_period(start_str, end_str, today):
+    start_date = parse_vacation_date(start_str, today.year)
+    end_date = parse_vacation_date(end_str, start_date.year)
+    # 28.12–05.01: конец периода уже в следующем году
+    if end_str.count(".") == 1 and end_date.month < start_date.month:
+        end_date = end_date.replace(year=end_date.year + 1)
+    # Каждый день периода — строка в базе: годами отпуск не берут
+    if (end_date - start_date).days >= MAX_VACATION_DAYS:
+        raise ValueError("слишком длинный период")
+    return start_date, end_date
 
-@dp.message_handler(lambda m: m.text == "📈 Аналитика")
+
+@router.text("❌ Отмена")
+async def cancel_action(message: types.Message):
+    on_shift = await storage.check_user_on_shift(message.from_user.id)
+    await message.answer("❌ Отменено.", reply_markup=get_main_menu(on_shift))
+
+async def send_backup(chat_id, caption):
+    if storage.path is None:
+        raise RuntimeError("бэкап делается средствами сервера БД")
+    info = await backup.create_backup(storage.path)
+    logging.info(f"[Бэкап] {info.path}: {info.size} байт за {info.duration:.2f} с")
+    metrics.backup_seconds.set(info.duration)
+    metrics.backup_bytes.set(info.size)
+    metrics.backup_timestamp.set(int(time.time()))
+    if chat_id:
+        await outbox.send(chat_id, lambda: bot.send_document(
+            chat_id, InputFile(info.path),
+            caption=f"{caption}\n📦 {backup.format_size(info.size)}\n🔐 sha256: {info.sha256}"
+        ))
+    return info
+
+async def send_archive(chat_id, year, path):
+    # Архивный файл есть только на диске бота: после переноса года копию — владельцу
+    info = await backup.create_backup(path, backup.ARCHIVE_NAME_FORMAT.format(year=year))
+    logging.info(f"[Архив] Копия {year}: {info.path}, {info.size} байт")
+    if chat_id:
+        await outbox.send(chat_id, lambda: bot.send_document(
+            chat_id, InputFile(info.path),
+            caption=f"🗄 Архив за {year}\n📦 {backup.format_size(info.size)}\n🔐 sha256: {info.sha256}"
+        ))
+    return info
+
+scheduler = Scheduler(storage)
+
+async def daily_backup():
+    await send_backup(OWNER_ID, "🗂 Бэкап за сегодня")
+
+if storage.path is not None:
+    scheduler.daily("backup", BACKUP_AT)(daily_backup)
+
+@scheduler.daily("reconcile", RECONCILE_AT)
+async def reconcile_open_shifts():
+    durations = {start: int(shift["duration"] * 60) for start, shift in SHIFTS.items()}
+    closed = await storage.close_stale_records(durations)
+    for user_id, day, _ in closed:
+        report_cache.invalidate(user_id, day)
+    if closed:
+        logging.info(f"[Сверка] Закрыто забытых смен: {len(closed)}, "
+                     f"пользователей: {len({user_id for user_id, _, _ in closed})}")
+    await asyncio.gather(*(
+        outbox.send_message(
+            user_id,
+            f"⚠️ {date.fromisoformat(day):%d.%m} не отмечен выход — смена закрыта, "
+            f"в долг записано {minutes // 60} ч {minutes % 60} мин."
+        )
+        for user_id, day, minutes in closed
+    ), return_exceptions=True)
+
+@scheduler.daily("archive", ARCHIVE_AT)
+async def archive_and_compact():
+    moved = await storage.archive_closed_years()
+    if moved:
+        # Отчёты за прошлые годы теперь строятся без перенесённых строк
+        report_cache.clear()
+    freed = await storage.compact()
+    if freed:
+        logging.info(f"[Архив] Освобождено страниц: {freed}")
+    for year, path, _, _ in moved:
+        await send_archive(OWNER_ID, year, path)
+
+@router.text("📈 Аналитика")
 async def analytics_handler(message: types.Message):
     user_id = message.from_user.id
     now = datetime.now()
-    first_day = date(now.year, now.month, 1)
 
-    conn = sqlite3.connect("data.sqlite")
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT date, entry_time, exit_time FROM records
-        WHERE user_id = ? AND date >= ? AND vacation = 0
-    """, (user_id, first_day.isoformat()))
-    rows = cur.fetchall()
-    conn.close()
+    stats = await storage.get_month_stats(user_id, now.strftime("%Y-%m"))
 
-    if not rows:
+    if not stats or not stats[0]:
         await message.answer("📈 Нет данных за этот месяц.")
         return
 
-    total_days = 0
-    total_minutes = 0
-    total_entry = []
-    total_exit = []
-    overtime_days = 0
-    debt_days = 0
-
-    for row in rows:
-        total_days += 1
-        entry = datetime.strptime(row[1], "%H:%M:%S")
-        if row[2]:
-            exit = datetime.strptime(row[2], "%H:%M:%S")
-            duration = (exit - entry).total_seconds() // 60
-            total_minutes += duration
-            total_entry.append(entry)
-            total_exit.append(exit)
-
-            if duration > 420:
-                overtime_days += 1
-            elif duration < 420:
-                debt_days += 1
+    total_days, closed_days, _, total_minutes, entry_minutes, exit_minutes, overtime_days, debt_days = stats
 
     avg_minutes = total_minutes // total_days if total_days else 0
-    avg_entry = (
-        sum([e.hour * 60 + e.minute for e in total_entry]) // len(total_entry)
-        if total_entry else None
-    )
-    avg_exit = (
-        sum([e.hour * 60 + e.minute for e in total_exit]) // len(total_exit)
-        if total_exit else None
-    )
+    avg_entry = entry_minutes // closed_days if closed_days else None
+    avg_exit = exit_minutes // closed_days if closed_days else None
 
     entry_time = f"{avg_entry // 60:02}:{avg_entry % 60:02}" if avg_entry else "—"
     exit_time = f"{avg_exit // 60:02}:{avg_exit % 60:02}" if avg_exit else "—"
@@ -546,19 +445,183 @@ async def analytics_handler(message: types.Message):
 
     await message.answer(report, parse_mode="Markdown")
 
-@dp.message_handler(lambda m: m.text == "📦 Бэкап сейчас")
+@router.text("📦 Бэкап сейчас")
 async def manual_backup(message: types.Message):
     if message.from_user.id != OWNER_ID:
         await message.answer("⛔ Только админ может получить бэкап.")
         return
 
     try:
-        with open("data.sqlite", "rb") as f:
-            await bot.send_document(message.from_user.id, InputFile(f, filename="data.sqlite"))
+        await send_backup(message.from_user.id, "🗂 Бэкап")
     except Exception as e:
         await message.answer(f"⚠️ Ошибка при отправке бэкапа: {e}")
 
+@dp.message_handler(commands=["rebuild_stats"])
+async def rebuild_stats(message: types.Message):
+    if message.from_user.id != OWNER_ID:
+        await message.answer("⛔ Только админ может пересчитать сводки.")
+        return
+
+    try:
+        mismatched = await storage.rebuild_rollups()
+    except RuntimeError as e:
+        await message.answer(f"⚠️ {e}")
+        return
+    await message.answer(f"🔄 Сводки пересчитаны.\n⚠️ Расхождений найдено: {mismatched}")
+
+@dp.message_handler(commands=["export"])
+async def export_handler(message: types.Message):
+    if message.from_user.id != OWNER_ID:
+        await message.answer("⛔ Только админ может выгружать отметки.")
+        return
+
+    args = message.get_args().split()
+    fmt = "csv"
+    if args and args[-1].lower() in ("csv", "xlsx"):
+        fmt = args.pop().lower()
+    today = date.today()
+    try:
+        first_day = datetime.strptime(args[0], "%d.%m.%Y").date() if args else today.replace(day=1)
+        last_day = datetime.strptime(args[1], "%d.%m.%Y").date() if len(args) > 1 else today
+    except ValueError:
+        await message.answer("⚠️ Пример: /export 01.09.2025 30.09.2025 xlsx")
+        return
+
+    try:
+        path, count = await storage.export_attendance(
+            authorization.users, first_day.isoformat(), last_day.isoformat(), fmt)
+    except RuntimeError as e:
+        await message.answer(f"⚠️ {e}")
+        return
+
+    try:
+        await bot.send_document(
+            message.chat.id,
+            InputFile(path, filename=f"attendance_{first_day:%d.%m.%Y}-{last_day:%d.%m.%Y}.{fmt}"),
+            caption=f"📤 Отметки за {first_day:%d.%m.%Y}–{last_day:%d.%m.%Y}: {count} строк"
+        )
+    finally:
+        os.remove(path)
+
+@dp.message_handler(commands=["broadcast"])
+async def broadcast_handler(message: types.Message):
+    if message.from_user.id != OWNER_ID:
+        await message.answer("⛔ Только админ может делать рассылку.")
+        return
+
+    text = message.get_args().strip()
+    if not text:
+        await message.answer("⚠️ Пример: /broadcast Завтра смена начинается в 08:00")
+        return
+
+    delivery = await outbox.broadcast(authorization.users, f"📢 {text}")
+    await message.answer(
+        f"📢 Рассылка: доставлено {delivery.sent} из {delivery.total} за {delivery.seconds:.1f} с\n"
+        f"⚠️ Ошибок: {delivery.failed} | 🔁 Повторов: {delivery.retries}"
+    )
+
+@dp.message_handler(commands=["allow", "deny"])
+async def manage_access(message: types.Message):
+    if message.from_user.id != OWNER_ID:
+        await message.answer("⛔ Только админ может менять доступ.")
+        return
+
+    command = message.get_command(pure=True)
+    user_ids = auth.parse_ids(message.get_args())
+    if not user_ids:
+        await message.answer(f"⚠️ Пример: /{command} 123456789 987654321")
+        return
+
+    if command == "allow":
+        changed = await authorization.add(user_ids)
+        await message.answer(f"✅ Доступ выдан: {changed} (всего с доступом: {len(authorization.users)})")
+    else:
+        changed = await authorization.remove([user_id for user_id in user_ids if user_id != OWNER_ID])
+        await message.answer(f"🚫 Доступ отозван: {changed} (всего с доступом: {len(authorization.users)})")
+
+@dp.message_handler(commands=["users"])
+async def list_users(message: types.Message):
+    if message.from_user.id != OWNER_ID:
+        await message.answer("⛔ Только админ может смотреть список доступа.")
+        return
+
+    ids = "\n".join(str(user_id) for user_id in sorted(authorization.users))
+    for part in split_message(f"👥 С доступом: {len(authorization.users)}\n{ids}"):
+        await message.answer(part)
+
+@dp.message_handler(commands=["profile"])
+async def profile_handler(message: types.Message):
+    if message.from_user.id != OWNER_ID:
+        await message.answer("⛔ Только админ может включать профилирование.")
+        return
+
+    args = message.get_args().split()
+    if not all(arg.isdigit() and int(arg) > 0 for arg in args[:2]):
+        await message.answer("⚠️ Пример: /profile 60 500 — до 60 секунд или до 500 обновлений")
+        return
+    seconds = min(int(args[0]) if args else 60, profiler.PROFILE_MAX_SECONDS)
+    max_updates = int(args[1]) if len(args) > 1 else 1000
+    # Сессия занимается до первого await: вторая такая же команда её уже увидит
+    try:
+        profiling.start(seconds, max_updates)
+    except RuntimeError as e:
+        await message.answer(f"⚠️ {e}.")
+        return
+
+    task = asyncio.create_task(send_profile(message.chat.id))
+    background_tasks.append(task)
+    task.add_done_callback(background_tasks.remove)
+    await message.answer(f"🔬 Профилирование: до {seconds} с или до {max_updates} обновлений.")
+
+async def send_profile(chat_id):
+    try:
+        report = await profiling.finish()
+    except Exception as e:
+        logging.exception("[Профиль] Ошибка профилирования")
+        await outbox.send_message(chat_id, f"⚠️ Профилирование не удалось: {e}")
+        return
+    logging.info(f"[Профиль] {report.seconds:.1f} с, обновлений {report.updates}, сэмплов {report.samples}")
+    try:
+        for part in split_message(report.summary):
+            await outbox.send_message(chat_id, part)
+        await outbox.send(chat_id, lambda: bot.send_document(
+            chat_id, InputFile(report.path, filename=f"profile_{datetime.now():%Y%m%d_%H%M%S}.collapsed.txt"),
+            caption="🔥 Стеки для flame graph (flamegraph.pl, speedscope)"
+        ))
+    except Exception as e:
+        logging.exception("[Профиль] Не удалось отправить профиль")
+        await outbox.send_message(chat_id, f"⚠️ Профиль не отправлен: {e}")
+    finally:
+        os.remove(report.path)
+
+# Кнопки меню — после команд, чтобы /команды не попадали в шаблоны
+router.setup(dp)
+
+background_tasks = []
+metrics_runner = None
+
+async def on_startup(dispatcher):
+    global metrics_runner
+    await storage.open()
+    await authorization.load()
+    if storage.shared:
+        background_tasks.append(asyncio.create_task(authorization.watch()))
+    if RUN_SCHEDULER:
+        background_tasks.append(asyncio.create_task(scheduler.run()))
+    metrics_runner = await metrics.start_server()
+
+async def on_shutdown(dispatcher):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await outbox.aclose()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await storage.close()
+
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.create_task(daily_backup())
-    executor.start_polling(dp, skip_updates=True)
+    if BOT_MODE == "webhook":
+        webhook.start_webhook(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,636 @@
+import asyncio
+import calendar
+import contextvars
+import functools
+import os
+import time
+import sqlite3
+import threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from itertools import chain
+
+import archive
+import export
+import metrics
+import rollups
+from migrations import migrate
+
+DB_PATH = os.getenv("DB_PATH", "data.sqlite")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+# Сколько ждать попутчиков перед коммитом и максимум записей в одной транзакции
+DB_COMMIT_DELAY = float(os.getenv("DB_COMMIT_DELAY_MS", "2")) / 1000
+DB_MAX_BATCH = int(os.getenv("DB_MAX_BATCH", "256"))
+# Дольше этого открытая смена не считается текущей
+MAX_SHIFT_HOURS = 16
+
+# Место вызова для метрик: имя функции этого модуля, из которой пришёл запрос
+query_site = contextvars.ContextVar("query_site", default="other")
+
+# Настройки соединения: WAL позволяет читателям не ждать писателя.
+# synchronous=FULL — коммит переживает отключение питания; fsync на
+# коммит амортизируется групповой записью.
+# auto_vacuum действует только на новую базу; существующую переводит
+# archive.enable_incremental_vacuum.
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=FULL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=67108864",
+)
+
+
+class Database:
+    """Долгоживущие соединения к SQLite, запросы выполняются вне event loop.
+
+    Все записи идут через один поток (у SQLite всё равно один писатель),
+    чтение — через небольшой пул потоков, у каждого своё соединение.
+    Записи копятся в очереди и коммитятся пачкой одной транзакцией
+    (group commit): каждая запись в своём SAVEPOINT, вызывающий получает
+    результат только после COMMIT.
+    """
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+        self._queue = None
+        self._committer = None
+        self.archives = []
+        self.archive_generation = 0
+        self.batches = 0
+        self.batched_writes = 0
+
+    def _connect(self):
+        # uri=True — чтобы архивы подключались только на чтение (file:...?mode=ro)
+        conn = sqlite3.connect(self.path, check_same_thread=False, uri=True)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            self._conns.append(conn)
+        return conn
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _reader_conn(self):
+        conn = self._conn()
+        # Набор архивов сменился — переподключаем их к этому читателю
+        if getattr(self._local, "archive_generation", None) != self.archive_generation:
+            archive.attach(conn, self.archives)
+            self._local.archive_generation = self.archive_generation
+        return conn
+
+    def set_archives(self, archives):
+        self.archives = archives
+        self.archive_generation += 1
+
+    def _run_read(self, fn, args, site):
+        started = time.perf_counter()
+        try:
+            return fn(self._reader_conn(), *args)
+        except Exception:
+            metrics.db_errors.inc(site)
+            raise
+        finally:
+            metrics.db_query_seconds.observe(time.perf_counter() - started, site, "read")
+
+    def _run_write(self, fn, args):
+        conn = self._conn()
+        with conn:
+            return fn(conn, *args)
+
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, fn, args, query_site.get())
+
+    def _run_batch(self, batch):
+        conn = self._conn()
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for fn, args, _, site in batch:
+                conn.execute("SAVEPOINT write")
+                started = time.perf_counter()
+                try:
+                    value = fn(conn, *args)
+                except Exception as e:
+                    # Откатываем только эту запись, остальные в пачке коммитятся
+                    conn.execute("ROLLBACK TO write")
+                    metrics.db_errors.inc(site)
+                    results.append((False, e))
+                else:
+                    results.append((True, value))
+                metrics.db_query_seconds.observe(time.perf_counter() - started, site, "write")
+                conn.execute("RELEASE write")
+            started = time.perf_counter()
+            conn.commit()
+            metrics.db_query_seconds.observe(time.perf_counter() - started, "group_commit", "commit")
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        return results
+
+    async def _commit_loop(self):
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            batch = [await self._queue.get()]
+            if DB_COMMIT_DELAY:
+                await asyncio.sleep(DB_COMMIT_DELAY)
+            while not self._queue.empty() and len(batch) < DB_MAX_BATCH:
+                batch.append(self._queue.get_nowait())
+            stop = None in batch
+            batch = [item for item in batch if item is not None]
+            if not batch:
+                continue
+
+            try:
+                results = await loop.run_in_executor(self._writer, self._run_batch, batch)
+            except Exception as e:
+                results = [(False, e)] * len(batch)
+            self.batches += 1
+            self.batched_writes += len(batch)
+
+            for (_, _, future, _), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def write(self, fn, *args):
+        if self._committer is None:
+            self._queue = asyncio.Queue()
+            self._committer = asyncio.create_task(self._commit_loop())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, args, future, query_site.get()))
+        return await future
+
+    async def maintenance(self, fn, *args):
+        # Вне групповой транзакции, но в потоке записи: ATTACH и VACUUM
+        # нельзя выполнять внутри транзакции, а очередь записей подождёт
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, lambda: fn(self._conn(), *args))
+
+    def write_sync(self, fn, *args):
+        # Для старта бота, когда event loop ещё не запущен
+        return self._writer.submit(self._run_write, fn, args).result()
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def aclose(self):
+        # Дожидаемся коммита всего, что уже стоит в очереди
+        if self._committer is not None:
+            self._queue.put_nowait(None)
+            await self._committer
+            self._committer = None
+        self.close()
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
+
+
+db = Database(DB_PATH)
+
+metrics.Gauge("wktb_db_write_queue_depth", "Записей в очереди группового коммита",
+              callback=lambda: db.queue_depth)
+metrics.Counter("wktb_db_commit_batches_total", "Групповых коммитов", callback=lambda: db.batches)
+metrics.Counter("wktb_db_batched_writes_total", "Записей в групповых коммитах", callback=lambda: db.batched_writes)
+
+
+def call_site(fn):
+    # Помечает запросы к базе именем функции для метрик
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        token = query_site.set(fn.__name__)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            query_site.reset(token)
+    return wrapper
+
+
+def init_db():
+    db.write_sync(migrate)
+    db.set_archives(db.write_sync(archive.archived))
+
+
+async def close_db():
+    await db.aclose()
+
+
+# --- Смены ---
+
+class ShiftCache:
+    """История смен пользователей в памяти процесса.
+
+    Для каждого пользователя хранится отсортированный список
+    (effective_from, start_time); смена на дату ищется бинарным поиском.
+    Загружается при первом обращении, обновляется при сохранении смены.
+    """
+
+    def __init__(self):
+        self._history = {}
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def history(self, user_id):
+        history = self._history.get(user_id)
+        if history is not None:
+            self.hits += 1
+            return history
+
+        self.misses += 1
+        version = self._versions.get(user_id, 0)
+        rows = await db.fetchall(
+            "SELECT effective_from, start_time FROM shifts WHERE user_id = ? ORDER BY effective_from",
+            (user_id,))
+        history = ([row[0] for row in rows], [row[1] for row in rows])
+        # Пока шёл запрос, смену могли сохранить — тогда не затираем свежие данные
+        if self._versions.get(user_id, 0) == version:
+            self._history[user_id] = history
+        return history
+
+    def put(self, user_id, history):
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        self._history[user_id] = history
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            for uid in self._history:
+                self._versions[uid] = self._versions.get(uid, 0) + 1
+            self._history.clear()
+        else:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._history.pop(user_id, None)
+
+
+shift_cache = ShiftCache()
+
+metrics.Counter("wktb_shift_cache_hits_total", "Попадания в кэш смен", callback=lambda: shift_cache.hits)
+metrics.Counter("wktb_shift_cache_misses_total", "Промахи кэша смен", callback=lambda: shift_cache.misses)
+
+
+@call_site
+async def user_has_shift(user_id):
+    dates, _ = await shift_cache.history(user_id)
+    return bool(dates)
+
+
+@call_site
+async def get_user_shift_time(user_id, target_date=None):
+    if target_date is None:
+        target_date = date.today().isoformat()
+    dates, times = await shift_cache.history(user_id)
+    i = bisect_right(dates, target_date)
+    return times[i - 1] if i else None
+
+
+def _save_shift(conn, user_id, start_time, effective_from):
+    conn.execute("DELETE FROM shifts WHERE user_id = ?", (user_id,))
+    conn.execute("INSERT INTO shifts (user_id, start_time, effective_from) VALUES (?, ?, ?)",
+                 (user_id, start_time, effective_from))
+
+
+@call_site
+async def save_shift(user_id, start_time, effective_from):
+    shift_cache.invalidate(user_id)
+    await db.write(_save_shift, user_id, start_time, effective_from)
+    shift_cache.put(user_id, ([effective_from], [start_time]))
+
+
+# --- Отметки ---
+
+def timestamp(moment):
+    # Время храним как «настенные» секунды: локальное время, записанное как UTC.
+    # Так strftime('%s', date || ' ' || time) в SQLite даёт то же число.
+    return calendar.timegm(moment.timetuple())
+
+
+def _open_record(conn, user_id, now_ts):
+    # Вечерняя смена может закончиться после полуночи: ищем и вчерашний вход
+    yesterday = datetime.utcfromtimestamp(now_ts - 86400).date().isoformat()
+    return conn.execute("""
+        SELECT date, entry_ts FROM records
+        WHERE user_id = ? AND exit_time IS NULL AND vacation = 0 AND date >= ? AND entry_ts >= ?
+        ORDER BY date DESC LIMIT 1
+    """, (user_id, yesterday, now_ts - MAX_SHIFT_HOURS * 3600)).fetchone()
+
+
+@call_site
+async def get_open_record(user_id, now_ts=None):
+    if now_ts is None:
+        now_ts = timestamp(datetime.now())
+    return await db.read(_open_record, user_id, now_ts)
+
+
+@call_site
+async def check_user_on_shift(user_id):
+    return await get_open_record(user_id) is not None
+
+
+def _add_entry(conn, user_id, username, day, entry_time, entry_ts):
+    # Отпускной день превращается в рабочий, повторный вход за день игнорируется
+    added = conn.execute("""
+        INSERT INTO records (user_id, username, date, entry_time, entry_ts) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, date) DO UPDATE
+        SET username = excluded.username, entry_time = excluded.entry_time,
+            entry_ts = excluded.entry_ts, vacation = 0
+        WHERE records.entry_time IS NULL
+    """, (user_id, username or "", day, entry_time, entry_ts)).rowcount > 0
+    if added:
+        rollups.refresh(conn, user_id, day)
+    return added
+
+
+@call_site
+async def add_entry(user_id, username, day, entry_time, entry_ts):
+    return await db.write(_add_entry, user_id, username, day, entry_time, entry_ts)
+
+
+def _close_day(conn, user_id, day, exit_time, exit_ts, overtime):
+    # Долг и выход пишутся одной транзакцией
+    if overtime < 0:
+        _update_debt(conn, user_id, day, -overtime)
+    elif overtime > 0:
+        _reduce_debt(conn, user_id, overtime, day)
+    conn.execute("""
+        UPDATE records SET exit_time = ?, exit_ts = ?
+        WHERE user_id = ? AND date = ? AND exit_time IS NULL
+    """, (exit_time, exit_ts, user_id, day))
+    rollups.refresh(conn, user_id, day)
+
+
+@call_site
+async def close_day(user_id, day, exit_time, exit_ts, overtime):
+    await db.write(_close_day, user_id, day, exit_time, exit_ts, overtime)
+
+
+def _close_stale(conn, cutoff_ts, durations):
+    # Забытые смены всех пользователей закрываются разом: выход = вход,
+    # в долг уходит вся плановая длительность смены на дату записи
+    conn.execute("DROP TABLE IF EXISTS temp.stale")
+    conn.execute(f"""
+        CREATE TEMP TABLE stale AS
+        WITH durations(start_time, minutes) AS (VALUES {", ".join(["(?, ?)"] * len(durations))})
+        SELECT r.id, r.user_id, r.date AS day, COALESCE(d.minutes, 0) AS minutes
+        FROM records r
+        LEFT JOIN durations d ON d.start_time = COALESCE(
+            (SELECT start_time FROM shifts s WHERE s.user_id = r.user_id AND s.effective_from <= r.date
+             ORDER BY s.effective_from DESC LIMIT 1),
+            (SELECT start_time FROM shifts s WHERE s.user_id = r.user_id
+             ORDER BY s.effective_from LIMIT 1)
+        )
+        WHERE r.exit_time IS NULL AND r.vacation = 0 AND r.entry_ts < ?
+    """, (*chain.from_iterable(durations.items()), cutoff_ts))
+    # Забытая смена закрывается через сутки с лишним, когда долг за следующие
+    # дни уже начислен. Погашение идёт по возрастанию accrued_total, поэтому
+    # начисление встаёт между днями: более поздние дни сдвигаются на его минуты
+    conn.execute("""
+        UPDATE debt_ledger SET accrued_total = accrued_total + (
+            SELECT SUM(s.minutes) FROM stale s
+            WHERE s.user_id = debt_ledger.user_id AND s.day < debt_ledger.day AND s.minutes > 0
+        )
+        WHERE kind = 'debt' AND EXISTS (
+            SELECT 1 FROM stale s
+            WHERE s.user_id = debt_ledger.user_id AND s.day < debt_ledger.day AND s.minutes > 0
+        )
+    """)
+    # Итог на день записи: баланс без более поздних начислений плюс забытые смены до неё
+    conn.execute("""
+        INSERT INTO debt_ledger (user_id, day, kind, minutes, accrued_total)
+        SELECT s.user_id, s.day, 'debt', s.minutes,
+               COALESCE(b.accrued, 0)
+               - (SELECT COALESCE(SUM(l.minutes), 0) FROM debt_ledger l
+                  WHERE l.user_id = s.user_id AND l.kind = 'debt' AND l.day > s.day)
+               + SUM(s.minutes) OVER (PARTITION BY s.user_id ORDER BY s.day ROWS UNBOUNDED PRECEDING)
+        FROM stale s LEFT JOIN debt_balance b ON b.user_id = s.user_id
+        WHERE s.minutes > 0
+        ORDER BY s.user_id, s.day
+    """)
+    conn.execute("""
+        INSERT INTO debt_balance (user_id, accrued)
+        SELECT user_id, SUM(minutes) FROM stale WHERE minutes > 0 GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET accrued = accrued + excluded.accrued
+    """)
+    conn.execute("""
+        UPDATE records SET exit_time = entry_time, exit_ts = entry_ts, auto_closed = 1
+        WHERE id IN (SELECT id FROM stale)
+    """)
+    rollups.refresh_days(conn, "temp.stale")
+    closed = conn.execute("SELECT user_id, day, minutes FROM stale ORDER BY user_id, day").fetchall()
+    conn.execute("DROP TABLE temp.stale")
+    return closed
+
+
+@call_site
+async def close_stale_records(durations, now_ts=None):
+    """Закрывает смены старше MAX_SHIFT_HOURS без выхода. durations — {начало смены: минут}.
+
+    Возвращает закрытые записи как (user_id, day, minutes долга).
+    """
+    if now_ts is None:
+        now_ts = timestamp(datetime.now())
+    return await db.write(_close_stale, now_ts - MAX_SHIFT_HOURS * 3600, durations)
+
+
+@call_site
+async def get_records_since(user_id, first_day):
+    return await db.fetchall("""
+        SELECT date, entry_time, exit_time, vacation, auto_closed
+        FROM records
+        WHERE user_id = ? AND date >= ?
+        ORDER BY date
+    """, (user_id, first_day))
+
+
+@call_site
+async def get_month_stats(user_id, month):
+    return await db.fetchone(f"""
+        SELECT {", ".join(rollups.MONTHLY_COLUMNS)} FROM monthly_stats
+        WHERE user_id = ? AND month = ?
+    """, (user_id, month))
+
+
+@call_site
+async def export_attendance(user_ids, first_day, last_day, fmt="csv"):
+    return await db.read(export.export_attendance, user_ids, first_day, last_day, fmt)
+
+
+@call_site
+async def get_job_runs():
+    return dict(await db.fetchall("SELECT name, last_run FROM job_runs"))
+
+
+@call_site
+async def save_job_run(name, last_run):
+    await db.execute("""
+        INSERT INTO job_runs (name, last_run) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET last_run = excluded.last_run
+    """, (name, last_run))
+
+
+# --- Доступ ---
+
+@call_site
+async def get_authorized_users():
+    return [row[0] for row in await db.fetchall("SELECT user_id FROM authorized_users")]
+
+
+def _add_authorized_users(conn, user_ids, added_at):
+    changes = conn.total_changes
+    conn.executemany("INSERT OR IGNORE INTO authorized_users (user_id, added_at) VALUES (?, ?)",
+                     [(user_id, added_at) for user_id in user_ids])
+    return conn.total_changes - changes
+
+
+@call_site
+async def add_authorized_users(user_ids):
+    return await db.write(_add_authorized_users, list(user_ids), datetime.now().isoformat(timespec="seconds"))
+
+
+def _remove_authorized_users(conn, user_ids):
+    changes = conn.total_changes
+    conn.executemany("DELETE FROM authorized_users WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+    return conn.total_changes - changes
+
+
+@call_site
+async def remove_authorized_users(user_ids):
+    return await db.write(_remove_authorized_users, list(user_ids))
+
+
+# --- Архив и сжатие ---
+
+def _archive_closed_years(conn, archive_dir):
+    return [
+        (year, archive.archive_path(archive_dir, year), *archive.archive_year(conn, archive_dir, year))
+        for year in archive.closed_years(conn)
+    ]
+
+
+@call_site
+async def archive_closed_years(archive_dir=archive.ARCHIVE_DIR):
+    """Переносит закрытые годы в архив. Возвращает [(год, файл, отметок, записей долга)]."""
+    moved = await db.maintenance(_archive_closed_years, archive_dir)
+    if moved:
+        db.set_archives(await db.read(archive.archived))
+    return moved
+
+
+def _compact(conn):
+    archive.enable_incremental_vacuum(conn)
+    return archive.incremental_vacuum(conn)
+
+
+@call_site
+async def compact():
+    """Возвращает файлу базы свободные страницы. Возвращает их число."""
+    return await db.maintenance(_compact)
+
+
+@call_site
+async def rebuild_rollups():
+    return await db.write(rollups.rebuild)
+
+
+def _add_vacation(conn, user_id, first_day, last_day):
+    # Все дни периода одним запросом; дни с реальными отметками не трогаем
+    total = (date.fromisoformat(last_day) - date.fromisoformat(first_day)).days + 1
+    changes = conn.total_changes
+    conn.execute("""
+        WITH RECURSIVE days(day) AS (
+            SELECT ? UNION ALL SELECT date(day, '+1 day') FROM days WHERE day < ?
+        )
+        INSERT INTO records (user_id, date, vacation)
+        SELECT ?, day, 1 FROM days WHERE true
+        ON CONFLICT (user_id, date) DO UPDATE SET vacation = 1
+        WHERE records.entry_time IS NULL AND records.exit_time IS NULL
+    """, (first_day, last_day, user_id))
+    # rowcount для запросов с WITH не заполняется
+    added = conn.total_changes - changes
+    if added:
+        rollups.refresh(conn, user_id, first_day, last_day)
+    return added, total - added
+
+
+@call_site
+async def add_vacation(user_id, first_day, last_day):
+    return await db.write(_add_vacation, user_id, first_day, last_day)
+
+
+# --- Долг ---
+
+@call_site
+async def get_total_debt(user_id):
+    row = await db.fetchone("SELECT accrued - paid FROM debt_balance WHERE user_id = ?", (user_id,))
+    return row[0] if row else 0
+
+
+@call_site
+async def get_debt_by_day(user_id):
+    return await db.fetchall("SELECT day, minutes FROM debt WHERE user_id = ? ORDER BY day", (user_id,))
+
+
+def _update_debt(conn, user_id, date_str, diff_minutes):
+    conn.execute("""
+        INSERT INTO debt_balance (user_id, accrued) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET accrued = accrued + excluded.accrued
+    """, (user_id, diff_minutes))
+    conn.execute("""
+        INSERT INTO debt_ledger (user_id, day, kind, minutes, accrued_total)
+        SELECT ?, ?, 'debt', ?, accrued FROM debt_balance WHERE user_id = ?
+    """, (user_id, date_str, diff_minutes, user_id))
+
+
+@call_site
+async def update_debt(user_id, date_str, diff_minutes):
+    await db.write(_update_debt, user_id, date_str, diff_minutes)
+
+
+def _reduce_debt(conn, user_id, minutes_available, date_str=None):
+    # Погашение сдвигает общий счётчик paid: дни закрываются по порядку сами собой
+    if date_str is None:
+        date_str = date.today().isoformat()
+    conn.execute("""
+        INSERT INTO debt_ledger (user_id, day, kind, minutes)
+        SELECT user_id, ?, 'payoff', MIN(accrued - paid, ?) FROM debt_balance
+        WHERE user_id = ? AND accrued > paid
+    """, (date_str, minutes_available, user_id))
+    conn.execute("UPDATE debt_balance SET paid = MIN(accrued, paid + ?) WHERE user_id = ?",
+                 (minutes_available, user_id))
+
+
+@call_site
+async def reduce_debt(user_id, minutes_available, date_str=None):
+    await db.write(_reduce_debt, user_id, minutes_available, date_str)
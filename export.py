@@ -0,0 +1,77 @@
+import csv
+import os
+import tempfile
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX необязателен, CSV работает всегда
+    Workbook = None
+
+CHUNK_ROWS = 1000
+
+HEADER = ("user_id", "username", "date", "entry_time", "exit_time", "vacation", "worked_minutes", "debt_minutes")
+
+# Отметки, отработанные минуты и начисленный за день долг.
+# Курсор читается кусками по CHUNK_ROWS, в памяти не держим весь период.
+# *_all — рабочая база вместе с подключёнными архивами прошлых лет.
+EXPORT_SQL = """
+    SELECT r.user_id, r.username, r.date, r.entry_time, r.exit_time, r.vacation,
+           r.worked_minutes, COALESCE(d.minutes, 0)
+    FROM records_all r
+    LEFT JOIN (
+        SELECT user_id, day, SUM(minutes) AS minutes FROM debt_ledger_all
+        WHERE kind = 'debt' AND day BETWEEN ? AND ?
+        GROUP BY user_id, day
+    ) d ON d.user_id = r.user_id AND d.day = r.date
+    WHERE r.user_id IN ({users}) AND r.date BETWEEN ? AND ?
+    ORDER BY r.user_id, r.date
+"""
+
+
+def _rows(conn, user_ids, first_day, last_day):
+    sql = EXPORT_SQL.format(users=", ".join("?" * len(user_ids)))
+    cursor = conn.execute(sql, (first_day, last_day, *user_ids, first_day, last_day))
+    while True:
+        chunk = cursor.fetchmany(CHUNK_ROWS)
+        if not chunk:
+            break
+        yield from chunk
+
+
+def _write_csv(rows, path):
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(HEADER)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def _write_xlsx(rows, path):
+    # write_only: строки сразу уходят во временный XML, а не в память
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Отметки")
+    sheet.append(HEADER)
+    count = 0
+    for row in rows:
+        sheet.append(list(row))
+        count += 1
+    workbook.save(path)
+    return count
+
+
+def export_attendance(conn, user_ids, first_day, last_day, fmt="csv"):
+    """Пишет отметки всех user_ids за период во временный файл. Возвращает (путь, число строк)."""
+    if fmt == "xlsx" and Workbook is None:
+        raise RuntimeError("Для выгрузки в XLSX нужен пакет openpyxl")
+    fd, path = tempfile.mkstemp(prefix=f"attendance-{first_day}-{last_day}-", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        rows = _rows(conn, list(user_ids), first_day, last_day)
+        count = _write_xlsx(rows, path) if fmt == "xlsx" else _write_csv(rows, path)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, count
@@ -0,0 +1,184 @@
+from bisect import bisect_right
+from datetime import date, timedelta
+
+from rollups import NORM_MINUTES
+from storage import Storage, open_cutoff
+
+
+class MemoryStorage(Storage):
+    """Хранилище в памяти процесса: для тестов и нагрузочных прогонов.
+
+    Повторяет поведение SQLite-бэкенда; каждый метод выполняется без
+    await внутри, поэтому в одном event loop он атомарен.
+    """
+
+    def __init__(self):
+        self.shifts = {}    # user_id -> [(effective_from, start_time)]
+        self.records = {}   # (user_id, date) -> dict
+        self.balance = {}   # user_id -> [accrued, paid]
+        self.ledger = {}    # user_id -> [(day, minutes, accrued_total)] начислений
+        self.job_runs = {}
+        self.authorized = set()
+
+    # --- Смены ---
+
+    def _shift_time(self, user_id, target_date):
+        history = self.shifts.get(user_id, [])
+        i = bisect_right([effective_from for effective_from, _ in history], target_date)
+        return history[i - 1][1] if i else None
+
+    async def user_has_shift(self, user_id):
+        return bool(self.shifts.get(user_id))
+
+    async def get_user_shift_time(self, user_id, target_date=None):
+        return self._shift_time(user_id, target_date or date.today().isoformat())
+
+    async def save_shift(self, user_id, start_time, effective_from):
+        self.shifts[user_id] = [(effective_from, start_time)]
+
+    # --- Отметки ---
+
+    async def add_entry(self, user_id, username, day, entry_time, entry_ts):
+        record = self.records.get((user_id, day))
+        if record is not None and record["entry_time"] is not None:
+            return False
+        if record is None:
+            record = self.records[(user_id, day)] = {"exit_time": None, "exit_ts": None, "auto_closed": 0}
+        record.update(username=username or "", entry_time=entry_time, entry_ts=entry_ts, vacation=0)
+        return True
+
+    def _open_records(self, user_id=None):
+        for (uid, day), record in self.records.items():
+            if (user_id is None or uid == user_id) and record["exit_time"] is None \
+                    and not record["vacation"] and record["entry_ts"] is not None:
+                yield uid, day, record
+
+    async def get_open_record(self, user_id, now_ts=None):
+        _, yesterday, earliest = open_cutoff(now_ts)
+        found = [(day, record["entry_ts"]) for _, day, record in self._open_records(user_id)
+                 if day >= yesterday and record["entry_ts"] >= earliest]
+        return max(found) if found else None
+
+    def _accrue(self, user_id, day, minutes):
+        balance = self.balance.setdefault(user_id, [0, 0])
+        balance[0] += minutes
+        self.ledger.setdefault(user_id, []).append((day, minutes, balance[0]))
+
+    def _accrue_before_later_days(self, user_id, day, minutes):
+        # Как в db._close_stale: начисление встаёт перед более поздними днями
+        balance = self.balance.setdefault(user_id, [0, 0])
+        ledger = self.ledger.setdefault(user_id, [])
+        later = [i for i, (d, _, _) in enumerate(ledger) if d > day]
+        for i in later:
+            d, m, total = ledger[i]
+            ledger[i] = (d, m, total + minutes)
+        total = balance[0] - sum(ledger[i][1] for i in later) + minutes
+        balance[0] += minutes
+        ledger.insert(later[0] if later else len(ledger), (day, minutes, total))
+
+    async def close_day(self, user_id, day, exit_time, exit_ts, overtime):
+        if overtime < 0:
+            self._accrue(user_id, day, -overtime)
+        elif overtime > 0 and user_id in self.balance:
+            balance = self.balance[user_id]
+            balance[1] = min(balance[0], balance[1] + overtime)
+        record = self.records.get((user_id, day))
+        if record is not None and record["exit_time"] is None:
+            record.update(exit_time=exit_time, exit_ts=exit_ts)
+
+    async def close_stale_records(self, durations, now_ts=None):
+        _, _, earliest = open_cutoff(now_ts)
+        closed = []
+        for user_id, day, record in sorted(self._open_records(), key=lambda item: item[:2]):
+            if record["entry_ts"] >= earliest:
+                continue
+            start_time = self._shift_time(user_id, day) or \
+                (self.shifts[user_id][0][1] if self.shifts.get(user_id) else None)
+            minutes = durations.get(start_time, 0)
+            if minutes > 0:
+                self._accrue_before_later_days(user_id, day, minutes)
+            record.update(exit_time=record["entry_time"], exit_ts=record["entry_ts"], auto_closed=1)
+            closed.append((user_id, day, minutes))
+        return closed
+
+    async def get_records_since(self, user_id, first_day):
+        return sorted(
+            (day, r["entry_time"], r["exit_time"], r["vacation"], r["auto_closed"])
+            for (uid, day), r in self.records.items() if uid == user_id and day >= first_day
+        )
+
+    async def get_month_stats(self, user_id, month):
+        # Те же правила, что у rollups.DAILY_SELECT
+        stats = [0] * 8
+        for (uid, day), r in self.records.items():
+            if uid != user_id or not day.startswith(month):
+                continue
+            if r["vacation"]:
+                stats[2] += 1
+                continue
+            stats[0] += 1
+            if r["entry_ts"] is None or r["exit_ts"] is None or r["auto_closed"]:
+                continue
+            worked = (r["exit_ts"] - r["entry_ts"]) // 60
+            stats[1] += 1
+            stats[3] += worked
+            stats[4] += r["entry_ts"] % 86400 // 60
+            stats[5] += r["exit_ts"] % 86400 // 60
+            stats[6] += worked > NORM_MINUTES
+            stats[7] += worked < NORM_MINUTES
+        return tuple(stats) if stats[0] or stats[2] else None
+
+    # --- Отпуска ---
+
+    async def add_vacation(self, user_id, first_day, last_day):
+        day, last = date.fromisoformat(first_day), date.fromisoformat(last_day)
+        added = skipped = 0
+        while day <= last:
+            record = self.records.get((user_id, day.isoformat()))
+            if record is None:
+                self.records[(user_id, day.isoformat())] = {
+                    "username": None, "entry_time": None, "exit_time": None, "vacation": 1,
+                    "entry_ts": None, "exit_ts": None, "auto_closed": 0,
+                }
+                added += 1
+            elif record["entry_time"] is None and record["exit_time"] is None:
+                record["vacation"] = 1
+                added += 1
+            else:
+                skipped += 1
+            day += timedelta(days=1)
+        return added, skipped
+
+    # --- Долг ---
+
+    async def get_total_debt(self, user_id):
+        accrued, paid = self.balance.get(user_id, (0, 0))
+        return accrued - paid
+
+    async def get_debt_by_day(self, user_id):
+        _, paid = self.balance.get(user_id, (0, 0))
+        return sorted((day, min(minutes, total - paid))
+                      for day, minutes, total in self.ledger.get(user_id, []) if total > paid)
+
+    # --- Доступ ---
+
+    async def get_authorized_users(self):
+        return list(self.authorized)
+
+    async def add_authorized_users(self, user_ids):
+        new = set(user_ids) - self.authorized
+        self.authorized |= new
+        return len(new)
+
+    async def remove_authorized_users(self, user_ids):
+        gone = set(user_ids) & self.authorized
+        self.authorized -= gone
+        return len(gone)
+
+    # --- Служебное ---
+
+    async def get_job_runs(self):
+        return dict(self.job_runs)
+
+    async def save_job_run(self, name, last_run):
+        self.job_runs[name] = last_run
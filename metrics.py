@@ -0,0 +1,164 @@
+import logging
+import os
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 — не поднимать /metrics
+
+# Границы в секундах: от долей миллисекунды (SQLite) до секунд (Telegram)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {value}")
+        return lines
+
+
+class Counter(Metric):
+    """Счётчик; с callback значение читается в момент выгрузки метрик."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+        self._callback = callback
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        if self._callback is not None:
+            return [("", "", self._callback())]
+        return [("", _labels(self.labelnames, k), v) for k, v in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными корзинами: observe() — один bisect и два сложения."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        result = []
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                result.append(("_bucket", _labels(self.labelnames, labels, f'le="{bound}"'), cumulative))
+            result.append(("_sum", _labels(self.labelnames, labels), round(total, 6)))
+            result.append(("_count", _labels(self.labelnames, labels), cumulative))
+        return result
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+handler_seconds = Histogram("wktb_handler_seconds", "Время обработки сообщения", ("handler",))
+db_query_seconds = Histogram("wktb_db_query_seconds", "Время запросов к SQLite", ("site", "kind"))
+db_errors = Counter("wktb_db_errors_total", "Ошибки запросов к SQLite", ("site",))
+telegram_seconds = Histogram("wktb_telegram_api_seconds", "Время вызовов Telegram Bot API", ("method",))
+telegram_errors = Counter("wktb_telegram_api_errors_total", "Ошибки вызовов Telegram Bot API", ("method",))
+backup_seconds = Gauge("wktb_backup_duration_seconds", "Длительность последнего бэкапа")
+backup_bytes = Gauge("wktb_backup_size_bytes", "Размер последнего бэкапа")
+backup_timestamp = Gauge("wktb_backup_last_success_timestamp", "Время последнего успешного бэкапа")
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет время обработки каждого сообщения по имени обработчика."""
+
+    async def on_pre_process_message(self, message, data):
+        data["_started"] = time.perf_counter()
+
+    async def on_process_message(self, message, data):
+        route = data.get("route")
+        handler = route or current_handler.get()
+        data["_handler"] = getattr(handler, "__name__", "unknown")
+
+    async def on_post_process_message(self, message, results, data):
+        started = data.get("_started")
+        if started is not None:
+            handler_seconds.observe(time.perf_counter() - started, data.get("_handler", "unhandled"))
+
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception:
+            telegram_errors.inc(method)
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - started, method)
+
+
+async def _metrics_view(request):
+    return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"[Метрики] http://{host}:{port}/metrics")
+    return runner
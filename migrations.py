@@ -0,0 +1,259 @@
+import logging
+from datetime import datetime
+
+import rollups
+
+
+# Каждый шаг выполняется в своей транзакции; номер версии = позиция в списке + 1.
+# Шаги только добавляются в конец, существующие не меняются.
+
+def _baseline(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            username TEXT,
+            date TEXT,
+            entry_time TEXT,
+            exit_time TEXT,
+            vacation INTEGER DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shifts (
+            user_id INTEGER,
+            start_time TEXT,
+            effective_from TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS debt (
+            user_id INTEGER,
+            day TEXT,
+            minutes INTEGER
+        )
+    """)
+
+
+def _indexes(conn):
+    # Одна запись на пользователя в день: дубли сливаем в самую раннюю строку —
+    # первый вход, последний выход; отпуск, только если отметок за день нет
+    conn.execute("""
+        CREATE TEMP TABLE merged AS
+        SELECT MIN(id) AS id, user_id, date, MAX(username) AS username,
+               MIN(entry_time) AS entry_time, MAX(exit_time) AS exit_time,
+               MAX(COALESCE(vacation, 0)) != 0 AND MIN(entry_time) IS NULL AND MAX(exit_time) IS NULL AS vacation
+        FROM records
+        WHERE user_id IS NOT NULL AND date IS NOT NULL
+        GROUP BY user_id, date
+        HAVING COUNT(*) > 1
+    """)
+    conn.execute("""
+        UPDATE records
+        SET username = m.username, entry_time = m.entry_time, exit_time = m.exit_time, vacation = m.vacation
+        FROM temp.merged m WHERE records.id = m.id
+    """)
+    removed = conn.execute("""
+        DELETE FROM records
+        WHERE (user_id, date) IN (SELECT user_id, date FROM temp.merged)
+          AND id NOT IN (SELECT id FROM temp.merged)
+    """).rowcount
+    if removed:
+        days = conn.execute("SELECT COUNT(*) FROM temp.merged").fetchone()[0]
+        logging.warning(f"[БД] Слиты дубли отметок: дней {days}, удалено строк {removed}")
+    conn.execute("DROP TABLE temp.merged")
+    # UNIQUE(user_id, date) — на нём работают INSERT OR REPLACE и ON CONFLICT
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_records_user_date ON records (user_id, date)")
+    # Отчёты и аналитика: WHERE user_id = ? AND date >= ? ORDER BY date, без обращения к таблице
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_records_user_date_cover
+        ON records (user_id, date, vacation, entry_time, exit_time)
+    """)
+    # Открытые смены: check_user_on_shift, handle_exit
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_records_open
+        ON records (user_id, date) WHERE exit_time IS NULL AND vacation = 0
+    """)
+    # get_user_shift: WHERE user_id = ? AND effective_from <= ? ORDER BY effective_from DESC
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_shifts_user_from
+        ON shifts (user_id, effective_from DESC, start_time)
+    """)
+    # get_total_debt и погашение долга по дням
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_debt_user_day ON debt (user_id, day, minutes)")
+
+
+def _debt_ledger(conn):
+    # Начисления и погашения только добавляются; для начисления хранится
+    # нарастающий итог начислений пользователя (accrued_total).
+    conn.execute("""
+        CREATE TABLE debt_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('debt', 'payoff')),
+            minutes INTEGER NOT NULL,
+            accrued_total INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX ix_debt_ledger_user ON debt_ledger (user_id, kind, accrued_total)")
+    # Баланс: долг = accrued - paid, погашение идёт по дням в порядке FIFO
+    conn.execute("""
+        CREATE TABLE debt_balance (
+            user_id INTEGER PRIMARY KEY,
+            accrued INTEGER NOT NULL DEFAULT 0,
+            paid INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        INSERT INTO debt_ledger (user_id, day, kind, minutes, accrued_total)
+        SELECT user_id, day, 'debt', minutes,
+               SUM(minutes) OVER (PARTITION BY user_id ORDER BY day, rowid ROWS UNBOUNDED PRECEDING)
+        FROM debt WHERE minutes > 0
+        ORDER BY user_id, day, rowid
+    """)
+    conn.execute("""
+        INSERT INTO debt_balance (user_id, accrued)
+        SELECT user_id, SUM(minutes) FROM debt WHERE minutes > 0 GROUP BY user_id
+    """)
+    conn.execute("DROP TABLE debt")
+    # Остаток долга по дням в прежнем виде (user_id, day, minutes)
+    conn.execute("""
+        CREATE VIEW debt AS
+        SELECT l.user_id, l.day, MIN(l.minutes, l.accrued_total - b.paid) AS minutes
+        FROM debt_ledger l
+        JOIN debt_balance b ON b.user_id = l.user_id
+        WHERE l.kind = 'debt' AND l.accrued_total > b.paid
+    """)
+
+
+def _rollups(conn):
+    rollups.create_tables(conn)
+    rollups.rebuild(conn)
+
+
+def _integer_times(conn):
+    # День и время как числа: day_num — дней от 1970-01-01, *_ts — секунды
+    # «настенного» времени. Выход раньше входа — смена через полночь.
+    conn.execute("ALTER TABLE records ADD COLUMN day_num INTEGER")
+    conn.execute("ALTER TABLE records ADD COLUMN entry_ts INTEGER")
+    conn.execute("ALTER TABLE records ADD COLUMN exit_ts INTEGER")
+    conn.execute("""
+        ALTER TABLE records ADD COLUMN worked_minutes INTEGER
+        GENERATED ALWAYS AS ((exit_ts - entry_ts) / 60) VIRTUAL
+    """)
+    conn.execute("""
+        UPDATE records SET
+            day_num = CAST(strftime('%s', date) AS INTEGER) / 86400,
+            entry_ts = CAST(strftime('%s', date || ' ' || entry_time) AS INTEGER),
+            exit_ts = CAST(strftime('%s', date || ' ' || exit_time) AS INTEGER)
+                      + CASE WHEN exit_time < entry_time THEN 86400 ELSE 0 END
+    """)
+    rollups.rebuild(conn)
+
+
+def _jobs(conn):
+    # Время последнего запуска фоновых задач переживает перезапуск бота;
+    # auto_closed — смена закрыта ночной сверкой, выход не отмечен
+    conn.execute("""
+        CREATE TABLE job_runs (
+            name TEXT PRIMARY KEY,
+            last_run TEXT NOT NULL
+        )
+    """)
+    conn.execute("ALTER TABLE records ADD COLUMN auto_closed INTEGER NOT NULL DEFAULT 0")
+
+
+def _authorized_users(conn):
+    # При первом запуске таблица один раз заполняется из AUTHORIZED_IDS
+    conn.execute("""
+        CREATE TABLE authorized_users (
+            user_id INTEGER PRIMARY KEY,
+            added_at TEXT NOT NULL
+        )
+    """)
+
+
+def _archive(conn):
+    # Годы, перенесённые в архивные файлы (archive.py)
+    conn.execute("""
+        CREATE TABLE archived_years (
+            year TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+    """)
+
+
+def _auto_closed_rollups(conn):
+    # Смены, закрытые ночной сверкой, больше не считаются закрытыми днями
+    conn.execute("""
+        CREATE TEMP TABLE auto_closed_days AS
+        SELECT user_id, date AS day FROM records WHERE auto_closed
+    """)
+    rollups.refresh_days(conn, "temp.auto_closed_days")
+    conn.execute("DROP TABLE temp.auto_closed_days")
+
+
+def _drop_day_num(conn):
+    # day_num с шага 5 ни один запрос не читал: день берётся из date, время — из *_ts
+    conn.execute("ALTER TABLE records DROP COLUMN day_num")
+
+
+def _ledger_day_order(conn):
+    # Ночная сверка дописывала долг забытых смен после более поздних дней;
+    # пересчитываем итоги в порядке дней от баланса назад — архив не нужен
+    conn.execute("""
+        UPDATE debt_ledger SET accrued_total = (
+            SELECT accrued FROM debt_balance b WHERE b.user_id = debt_ledger.user_id
+        ) - (
+            SELECT COALESCE(SUM(l.minutes), 0) FROM debt_ledger l
+            WHERE l.user_id = debt_ledger.user_id AND l.kind = 'debt'
+              AND (l.day, l.id) > (debt_ledger.day, debt_ledger.id)
+        )
+        WHERE kind = 'debt'
+    """)
+
+
+MIGRATIONS = [
+    _baseline,
+    _indexes,
+    _debt_ledger,
+    _rollups,
+    _integer_times,
+    _jobs,
+    _authorized_users,
+    _archive,
+    _auto_closed_rollups,
+    _drop_day_num,
+    _ledger_day_order,
+]
+
+
+def current_version(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TEXT
+        )
+    """)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    if conn.in_transaction:
+        conn.commit()
+    version = current_version(conn)
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"[БД] Миграция {number}: {step.__name__}")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            step(conn)
+            conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                         (number, datetime.now().isoformat(timespec="seconds")))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return len(MIGRATIONS)
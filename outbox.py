@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.utils.exceptions import NetworkError, RetryAfter
+
+import metrics
+
+# Telegram пропускает около 30 сообщений в секунду на бота и примерно
+# одно в секунду в один чат; берём с запасом
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "25"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "16"))
+OUTBOX_RETRIES = int(os.getenv("OUTBOX_RETRIES", "5"))
+# Столько ведёр по чатам держим, прежде чем выбросить давно не использованные
+CHAT_BUCKETS = 4096
+
+sent_total = metrics.Counter("wktb_outbox_sent_total", "Доставленных исходящих сообщений")
+failed_total = metrics.Counter("wktb_outbox_failed_total", "Недоставленных исходящих сообщений")
+retry_after_total = metrics.Counter("wktb_outbox_retry_after_total", "Ответов RetryAfter от Telegram")
+
+
+class TokenBucket:
+    """Ведро токенов: rate в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Delivery:
+    """Статистика доставки одной рассылки."""
+
+    def __init__(self, total=0):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def seconds(self):
+        return (self.finished or time.monotonic()) - self.started
+
+
+class Outbox:
+    """Очередь исходящих сообщений с ограничением скорости.
+
+    Каждая отправка ждёт токен своего чата и общий токен бота. На
+    RetryAfter притормаживаются все отправки (флуд-контроль считается на
+    бота) и сообщение повторяется; сетевые ошибки повторяются с
+    экспоненциальной паузой. Остальные ошибки API (бот заблокирован, чат
+    не найден) не повторяются.
+    """
+
+    def __init__(self, bot, rate=OUTBOX_RATE, chat_rate=OUTBOX_CHAT_RATE, workers=OUTBOX_WORKERS):
+        self.bot = bot
+        self.limiter = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self._chats = {}
+        self._resume_at = 0.0
+        self._queue = None
+        self._tasks = []
+        metrics.Gauge("wktb_outbox_queue_depth", "Сообщений в исходящей очереди",
+                      callback=lambda: self._queue.qsize() if self._queue is not None else 0)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS:
+                idle = time.monotonic() - 60
+                self._chats = {k: v for k, v in self._chats.items() if v.updated > idle}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    async def _deliver(self, chat_id, factory, delivery):
+        attempt = 0
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            pause = self._resume_at - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.limiter.acquire()
+            try:
+                return await factory()
+            except RetryAfter as e:
+                retry_after_total.inc()
+                self._resume_at = max(self._resume_at, time.monotonic() + e.timeout)
+                logging.warning(f"[Рассылка] RetryAfter {e.timeout} с, чат {chat_id}")
+                delay = 0
+                if attempt >= OUTBOX_RETRIES:
+                    raise
+            except (NetworkError, asyncio.TimeoutError):
+                delay = min(2 ** attempt, 30)
+                if attempt >= OUTBOX_RETRIES:
+                    raise
+            attempt += 1
+            delivery.retries += 1
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                break
+            chat_id, factory, future, delivery = item
+            try:
+                result = await self._deliver(chat_id, factory, delivery)
+            except Exception as e:
+                delivery.failed += 1
+                failed_total.inc()
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                delivery.sent += 1
+                sent_total.inc()
+                if not future.done():
+                    future.set_result(result)
+
+    def _enqueue(self, chat_id, factory, delivery):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((chat_id, factory, future, delivery))
+        return future
+
+    async def send(self, chat_id, factory):
+        """Отправляет один запрос: factory() создаёт корутину вызова API, на повторе — новую."""
+        return await self._enqueue(chat_id, factory, Delivery(1))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.send(chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs))
+
+    async def broadcast(self, chat_ids, text, **kwargs):
+        """Рассылает text всем chat_ids разом; возвращает Delivery."""
+        chat_ids = list(dict.fromkeys(chat_ids))
+        delivery = Delivery(len(chat_ids))
+        futures = [
+            self._enqueue(chat_id, lambda chat_id=chat_id: self.bot.send_message(chat_id, text, **kwargs), delivery)
+            for chat_id in chat_ids
+        ]
+        await asyncio.gather(*futures, return_exceptions=True)
+        delivery.finished = time.monotonic()
+        logging.info(f"[Рассылка] {delivery.sent}/{delivery.total} за {delivery.seconds:.1f} с, "
+                     f"ошибок {delivery.failed}, повторов {delivery.retries}")
+        return delivery
+
+    async def aclose(self):
+        # Досылаем то, что уже в очереди
+        if self._queue is None:
+            return
+        for _ in self._tasks:
+            self._queue.put_nowait(None)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._queue = None
+        self._tasks = []
@@ -0,0 +1,330 @@
+import logging
+import os
+from datetime import date
+
+try:
+    import asyncpg
+except ImportError:  # нужен только при STORAGE_URL=postgresql://...
+    asyncpg = None
+
+from rollups import NORM_MINUTES
+from storage import Storage, open_cutoff
+
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+
+# Даты и время хранятся строками, как в SQLite, чтобы бэкенды отдавали
+# одинаковые строки. Схема создаётся при старте и только дополняется.
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS shifts (
+        user_id BIGINT NOT NULL,
+        start_time TEXT NOT NULL,
+        effective_from TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_shifts_user_from ON shifts (user_id, effective_from)",
+    """
+    CREATE TABLE IF NOT EXISTS records (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        username TEXT,
+        date TEXT NOT NULL,
+        entry_time TEXT,
+        exit_time TEXT,
+        vacation INTEGER NOT NULL DEFAULT 0,
+        entry_ts BIGINT,
+        exit_ts BIGINT,
+        auto_closed INTEGER NOT NULL DEFAULT 0,
+        worked_minutes BIGINT GENERATED ALWAYS AS ((exit_ts - entry_ts) / 60) STORED,
+        UNIQUE (user_id, date)
+    )
+    """,
+    # day_num никто не читал: день берётся из date, время — из *_ts
+    "ALTER TABLE records DROP COLUMN IF EXISTS day_num",
+    "CREATE INDEX IF NOT EXISTS ix_records_open ON records (user_id, date) WHERE exit_time IS NULL AND vacation = 0",
+    """
+    CREATE TABLE IF NOT EXISTS debt_ledger (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        day TEXT NOT NULL,
+        kind TEXT NOT NULL CHECK (kind IN ('debt', 'payoff')),
+        minutes INTEGER NOT NULL,
+        accrued_total BIGINT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_debt_ledger_user ON debt_ledger (user_id, kind, accrued_total)",
+    """
+    CREATE TABLE IF NOT EXISTS debt_balance (
+        user_id BIGINT PRIMARY KEY,
+        accrued BIGINT NOT NULL DEFAULT 0,
+        paid BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE OR REPLACE VIEW debt AS
+    SELECT l.user_id, l.day, LEAST(l.minutes, l.accrued_total - b.paid) AS minutes
+    FROM debt_ledger l
+    JOIN debt_balance b ON b.user_id = l.user_id
+    WHERE l.kind = 'debt' AND l.accrued_total > b.paid
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS authorized_users (
+        user_id BIGINT PRIMARY KEY,
+        added_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS job_runs (
+        name TEXT PRIMARY KEY,
+        last_run TEXT NOT NULL
+    )
+    """,
+)
+
+# Смена на дату записи; если смену сменили позже, берём самую раннюю
+SHIFT_AT_DATE = """
+    COALESCE(
+        (SELECT start_time FROM shifts s WHERE s.user_id = r.user_id AND s.effective_from <= r.date
+         ORDER BY s.effective_from DESC LIMIT 1),
+        (SELECT start_time FROM shifts s WHERE s.user_id = r.user_id ORDER BY s.effective_from LIMIT 1)
+    )
+"""
+
+# Месячная сводка прямо по records: индекс (user_id, date) сужает выборку до месяца
+MONTH_STATS_SQL = f"""
+    SELECT COUNT(*) FILTER (WHERE vacation = 0),
+           COUNT(*) FILTER (WHERE closed),
+           COUNT(*) FILTER (WHERE vacation != 0),
+           COALESCE(SUM(worked_minutes) FILTER (WHERE closed), 0)::bigint,
+           COALESCE(SUM(entry_ts % 86400 / 60) FILTER (WHERE closed), 0)::bigint,
+           COALESCE(SUM(exit_ts % 86400 / 60) FILTER (WHERE closed), 0)::bigint,
+           COUNT(*) FILTER (WHERE closed AND worked_minutes > {NORM_MINUTES}),
+           COUNT(*) FILTER (WHERE closed AND worked_minutes < {NORM_MINUTES})
+    FROM (
+        SELECT vacation, worked_minutes, entry_ts, exit_ts,
+               vacation = 0 AND entry_ts IS NOT NULL AND exit_ts IS NOT NULL AND auto_closed = 0 AS closed
+        FROM records
+        WHERE user_id = $1 AND date >= $2 AND date < $3
+    ) m
+"""
+
+
+def _next_month(month):
+    year, number = map(int, month.split("-"))
+    return f"{year + number // 12:04}-{number % 12 + 1:02}"
+
+
+def _rowcount(status):
+    # asyncpg возвращает статус команды: "INSERT 0 5", "UPDATE 3"
+    return int(status.rsplit(" ", 1)[-1])
+
+
+class PostgresStorage(Storage):
+    """PostgreSQL через пул asyncpg: общие данные для нескольких процессов бота.
+
+    Запись, которую нельзя выразить одним запросом, идёт в транзакции;
+    конкурентные отметки разводит уникальный ключ (user_id, date), а
+    баланс долга — блокировка строки debt_balance при upsert.
+    """
+
+    shared = True
+
+    def __init__(self, url):
+        if asyncpg is None:
+            raise RuntimeError("Для PostgreSQL нужен пакет asyncpg")
+        self.url = url
+        self.pool = None
+
+    async def open(self):
+        self.pool = await asyncpg.create_pool(self.url, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Несколько процессов могут стартовать одновременно
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('wktb_schema'))")
+                for statement in SCHEMA:
+                    await conn.execute(statement)
+        logging.info("[БД] PostgreSQL подключён")
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    # --- Смены ---
+
+    async def user_has_shift(self, user_id):
+        return await self.pool.fetchval("SELECT EXISTS (SELECT 1 FROM shifts WHERE user_id = $1)", user_id)
+
+    async def get_user_shift_time(self, user_id, target_date=None):
+        return await self.pool.fetchval("""
+            SELECT start_time FROM shifts WHERE user_id = $1 AND effective_from <= $2
+            ORDER BY effective_from DESC LIMIT 1
+        """, user_id, target_date or date.today().isoformat())
+
+    async def save_shift(self, user_id, start_time, effective_from):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM shifts WHERE user_id = $1", user_id)
+                await conn.execute("INSERT INTO shifts (user_id, start_time, effective_from) VALUES ($1, $2, $3)",
+                                   user_id, start_time, effective_from)
+
+    # --- Отметки ---
+
+    async def add_entry(self, user_id, username, day, entry_time, entry_ts):
+        status = await self.pool.execute("""
+            INSERT INTO records (user_id, username, date, entry_time, entry_ts)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (user_id, date) DO UPDATE
+            SET username = excluded.username, entry_time = excluded.entry_time,
+                entry_ts = excluded.entry_ts, vacation = 0
+            WHERE records.entry_time IS NULL
+        """, user_id, username or "", day, entry_time, entry_ts)
+        return _rowcount(status) > 0
+
+    async def get_open_record(self, user_id, now_ts=None):
+        _, yesterday, earliest = open_cutoff(now_ts)
+        row = await self.pool.fetchrow("""
+            SELECT date, entry_ts FROM records
+            WHERE user_id = $1 AND exit_time IS NULL AND vacation = 0 AND date >= $2 AND entry_ts >= $3
+            ORDER BY date DESC LIMIT 1
+        """, user_id, yesterday, earliest)
+        return tuple(row) if row else None
+
+    async def close_day(self, user_id, day, exit_time, exit_ts, overtime):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if overtime < 0:
+                    await conn.execute("""
+                        WITH balance AS (
+                            INSERT INTO debt_balance (user_id, accrued) VALUES ($1, $3)
+                            ON CONFLICT (user_id) DO UPDATE SET accrued = debt_balance.accrued + excluded.accrued
+                            RETURNING accrued
+                        )
+                        INSERT INTO debt_ledger (user_id, day, kind, minutes, accrued_total)
+                        SELECT $1, $2, 'debt', $3, accrued FROM balance
+                    """, user_id, day, -overtime)
+                elif overtime > 0:
+                    await conn.execute("""
+                        WITH balance AS (
+                            SELECT accrued, paid FROM debt_balance WHERE user_id = $1 FOR UPDATE
+                        ), payoff AS (
+                            INSERT INTO debt_ledger (user_id, day, kind, minutes)
+                            SELECT $1, $2, 'payoff', LEAST(accrued - paid, $3) FROM balance
+                            WHERE accrued > paid
+                        )
+                        UPDATE debt_balance SET paid = LEAST(accrued, paid + $3) WHERE user_id = $1
+                    """, user_id, day, overtime)
+                await conn.execute("""
+                    UPDATE records SET exit_time = $3, exit_ts = $4
+                    WHERE user_id = $1 AND date = $2 AND exit_time IS NULL
+                """, user_id, day, exit_time, exit_ts)
+
+    async def close_stale_records(self, durations, now_ts=None):
+        _, _, earliest = open_cutoff(now_ts)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch(f"""
+                    WITH stale AS (
+                        SELECT r.id, r.user_id, r.date AS day, COALESCE(d.minutes, 0) AS minutes
+                        FROM records r
+                        LEFT JOIN unnest($2::text[], $3::int[]) AS d(start_time, minutes)
+                               ON d.start_time = {SHIFT_AT_DATE}
+                        WHERE r.exit_time IS NULL AND r.vacation = 0 AND r.entry_ts < $1
+                        FOR UPDATE OF r
+                    ), accrued AS (
+                        INSERT INTO debt_balance (user_id, accrued)
+                        SELECT user_id, SUM(minutes) FROM stale WHERE minutes > 0 GROUP BY user_id
+                        ON CONFLICT (user_id) DO UPDATE SET accrued = debt_balance.accrued + excluded.accrued
+                        RETURNING user_id, accrued
+                    ), shifted AS (
+                        -- Начисления за более поздние дни сдвигаются: погашение идёт по дням
+                        UPDATE debt_ledger l SET accrued_total = l.accrued_total + x.minutes
+                        FROM (
+                            SELECT l.id, SUM(s.minutes) AS minutes
+                            FROM debt_ledger l JOIN stale s ON s.user_id = l.user_id AND s.day < l.day
+                            WHERE l.kind = 'debt' AND s.minutes > 0
+                            GROUP BY l.id
+                        ) x
+                        WHERE l.id = x.id
+                    ), ledger AS (
+                        -- Итог на день записи: новый баланс без более поздних начислений
+                        INSERT INTO debt_ledger (user_id, day, kind, minutes, accrued_total)
+                        SELECT s.user_id, s.day, 'debt', s.minutes,
+                               a.accrued - SUM(s.minutes) OVER (PARTITION BY s.user_id ORDER BY s.day DESC)
+                               + s.minutes
+                               - (SELECT COALESCE(SUM(l.minutes), 0) FROM debt_ledger l
+                                  WHERE l.user_id = s.user_id AND l.kind = 'debt' AND l.day > s.day)
+                        FROM stale s JOIN accrued a ON a.user_id = s.user_id
+                        WHERE s.minutes > 0
+                    ), closed AS (
+                        UPDATE records r SET exit_time = entry_time, exit_ts = entry_ts, auto_closed = 1
+                        FROM stale s WHERE r.id = s.id
+                    )
+                    SELECT user_id, day, minutes FROM stale ORDER BY user_id, day
+                """, earliest, list(durations), list(durations.values()))
+        return [tuple(row) for row in rows]
+
+    async def get_records_since(self, user_id, first_day):
+        rows = await self.pool.fetch("""
+            SELECT date, entry_time, exit_time, vacation, auto_closed
+            FROM records
+            WHERE user_id = $1 AND date >= $2
+            ORDER BY date
+        """, user_id, first_day)
+        return [tuple(row) for row in rows]
+
+    async def get_month_stats(self, user_id, month):
+        row = await self.pool.fetchrow(MONTH_STATS_SQL, user_id, f"{month}-01", f"{_next_month(month)}-01")
+        return tuple(row) if row[0] or row[2] else None
+
+    # --- Отпуска ---
+
+    async def add_vacation(self, user_id, first_day, last_day):
+        total = (date.fromisoformat(last_day) - date.fromisoformat(first_day)).days + 1
+        status = await self.pool.execute("""
+            INSERT INTO records (user_id, date, vacation)
+            SELECT $1, to_char(day, 'YYYY-MM-DD'), 1
+            FROM generate_series($2::date, $3::date, interval '1 day') AS day
+            ON CONFLICT (user_id, date) DO UPDATE SET vacation = 1
+            WHERE records.entry_time IS NULL AND records.exit_time IS NULL
+        """, user_id, date.fromisoformat(first_day), date.fromisoformat(last_day))
+        added = _rowcount(status)
+        return added, total - added
+
+    # --- Долг ---
+
+    async def get_total_debt(self, user_id):
+        return await self.pool.fetchval("SELECT accrued - paid FROM debt_balance WHERE user_id = $1", user_id) or 0
+
+    async def get_debt_by_day(self, user_id):
+        rows = await self.pool.fetch("SELECT day, minutes FROM debt WHERE user_id = $1 ORDER BY day", user_id)
+        return [tuple(row) for row in rows]
+
+    # --- Доступ ---
+
+    async def get_authorized_users(self):
+        return [row[0] for row in await self.pool.fetch("SELECT user_id FROM authorized_users")]
+
+    async def add_authorized_users(self, user_ids):
+        status = await self.pool.execute("""
+            INSERT INTO authorized_users (user_id) SELECT unnest($1::bigint[])
+            ON CONFLICT (user_id) DO NOTHING
+        """, list(user_ids))
+        return _rowcount(status)
+
+    async def remove_authorized_users(self, user_ids):
+        status = await self.pool.execute("DELETE FROM authorized_users WHERE user_id = ANY($1::bigint[])",
+                                         list(user_ids))
+        return _rowcount(status)
+
+    # --- Служебное ---
+
+    async def get_job_runs(self):
+        return dict(await self.pool.fetch("SELECT name, last_run FROM job_runs"))
+
+    async def save_job_run(self, name, last_run):
+        await self.pool.execute("""
+            INSERT INTO job_runs (name, last_run) VALUES ($1, $2)
+            ON CONFLICT (name) DO UPDATE SET last_run = excluded.last_run
+        """, name, last_run)
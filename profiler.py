@@ -0,0 +1,150 @@
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, namedtuple
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
+# Частота снятия стеков всех потоков
+PROFILE_HZ = int(os.getenv("PROFILE_HZ", "200"))
+SUMMARY_ROWS = 25
+
+# Поток ждёт работу или ответ сети: такие сэмплы не считаем занятостью
+IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+ProfileReport = namedtuple("ProfileReport", "summary path seconds updates samples")
+
+
+def _label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class _Sampler(threading.Thread):
+    """Раз в 1/hz секунды снимает стеки всех потоков в формате collapsed stacks."""
+
+    def __init__(self, hz):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.interval = 1 / hz
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Profiler:
+    """Профилирование по команде владельца; в выключенном виде ничего не делает.
+
+    Пока сессия идёт, cProfile считает время вызовов в потоке event loop,
+    а отдельный поток снимает стеки всех потоков (включая потоки SQLite),
+    из которых получается файл для flame graph. Сессия заканчивается по
+    времени или после заданного числа обновлений.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.updates = 0
+        self.max_updates = 0
+        self.seconds = 0
+        self._done = None
+        self._profile = None
+        self._sampler = None
+        self._started = None
+
+    def count_update(self):
+        self.updates += 1
+        if self.updates >= self.max_updates:
+            self._done.set()
+
+    def start(self, seconds, max_updates):
+        """Включает профилирование; без await, чтобы две команды не заняли сессию обе."""
+        if self.active:
+            raise RuntimeError("Профилирование уже идёт")
+        self.updates = 0
+        self.max_updates = max_updates
+        self.seconds = seconds
+        self._done = asyncio.Event()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self._sampler = _Sampler(PROFILE_HZ)
+        try:
+            self._sampler.start()
+        except BaseException:
+            self._profile.disable()
+            raise
+        self._started = time.monotonic()
+        self.active = True
+
+    async def finish(self):
+        """Ждёт конца сессии по времени или числу обновлений и возвращает ProfileReport."""
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout=self.seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._profile.disable()
+            self._sampler.stop()
+            self.active = False
+        return self._report(self._profile, self._sampler, time.monotonic() - self._started)
+
+    def _report(self, profile, sampler, seconds):
+        fd, path = tempfile.mkstemp(prefix="profile-", suffix=".collapsed.txt")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for stack, count in sorted(sampler.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+        lines = [f"🔬 Профиль: {seconds:.1f} с, обновлений {self.updates}, сэмплов {sampler.samples}", ""]
+        # Занятость потоков по сэмплам: доля, когда поток не ждал работу или сеть
+        busy = Counter()
+        for stack, count in sampler.stacks.items():
+            frames = stack.split(";")
+            if not frames[-1].startswith(IDLE_FILES):
+                busy[frames[0]] += count
+        if sampler.samples:
+            lines.append("Потоки (занят, % времени):")
+            for thread, count in busy.most_common():
+                lines.append(f"  {thread}: {100 * count / sampler.samples:.0f}%")
+            lines.append("")
+
+        stats = pstats.Stats(profile).stats
+        rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:SUMMARY_ROWS]
+        lines.append("cum мс | own мс | вызовов | функция")
+        for (filename, line, name), (_, calls, own, cumulative, _) in rows:
+            where = f"{os.path.basename(filename)}:{line}" if line else filename
+            lines.append(f"{cumulative * 1000:7.1f} | {own * 1000:6.1f} | {calls:6} | {where} {name}")
+        return ProfileReport("\n".join(lines), path, seconds, self.updates, sampler.samples)
+
+
+class ProfilerMiddleware(BaseMiddleware):
+    """Считает обработанные обновления для ограничения сессии по их числу."""
+
+    def __init__(self, profiler):
+        super().__init__()
+        self.profiler = profiler
+
+    async def on_post_process_update(self, update, results, data):
+        if self.profiler.active:
+            self.profiler.count_update()
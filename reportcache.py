@@ -0,0 +1,100 @@
+import os
+import time
+from collections import OrderedDict
+
+import metrics
+
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "2000"))
+REPORT_CACHE_TTL = int(os.getenv("REPORT_CACHE_TTL", "900"))
+
+TELEGRAM_LIMIT = 4096
+
+
+def split_message(text, limit=TELEGRAM_LIMIT):
+    """Режет текст на части не длиннее limit, по возможности по строкам."""
+    parts = []
+    current = []
+    size = 0
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                parts.append("\n".join(current))
+                current, size = [], 0
+            parts.append(line[:limit])
+            line = line[limit:]
+        extra = len(line) + (1 if current else 0)
+        if size + extra > limit:
+            parts.append("\n".join(current))
+            current, size = [], 0
+            extra = len(line)
+        current.append(line)
+        size += extra
+    if current:
+        parts.append("\n".join(current))
+    return parts
+
+
+class ReportCache:
+    """LRU-кэш готовых отчётов с TTL.
+
+    Ключ — (user_id, вид отчёта, первый день периода). Отчёт за период
+    показывает все записи начиная с первого дня, поэтому запись за день D
+    сбрасывает отчёты пользователя, у которых начало периода <= D.
+    """
+
+    def __init__(self, maxsize=REPORT_CACHE_SIZE, ttl=REPORT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._by_user = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, kind, start):
+        key = (user_id, kind, start)
+        item = self._items.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, user_id, kind, start, parts):
+        key = (user_id, kind, start)
+        self._items[key] = (time.monotonic() + self.ttl, parts)
+        self._items.move_to_end(key)
+        self._by_user.setdefault(user_id, set()).add(key)
+        while len(self._items) > self.maxsize:
+            self._remove(next(iter(self._items)))
+
+    def invalidate(self, user_id, first_day, last_day=None):
+        last_day = last_day or first_day
+        for key in [k for k in self._by_user.get(user_id, ()) if k[2] <= last_day]:
+            self._remove(key)
+
+    def clear(self):
+        self._items.clear()
+        self._by_user.clear()
+
+    def disable(self):
+        # Отчёты больше не сохраняются: put сразу вытесняет запись
+        self.maxsize = 0
+        self.clear()
+
+    def _remove(self, key):
+        self._items.pop(key, None)
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
+
+
+report_cache = ReportCache()
+
+metrics.Counter("wktb_report_cache_hits_total", "Попадания в кэш отчётов", callback=lambda: report_cache.hits)
+metrics.Counter("wktb_report_cache_misses_total", "Промахи кэша отчётов", callback=lambda: report_cache.misses)
+metrics.Gauge("wktb_report_cache_size", "Отчётов в кэше", callback=lambda: len(report_cache._items))
@@ -0,0 +1,173 @@
+# Сводки для аналитики: строка на пользователя в день и в месяц.
+# Обновляются в той же транзакции, что и отметки, поэтому аналитика
+# читает одну строку monthly_stats вместо всех записей месяца.
+
+NORM_MINUTES = 420
+
+MONTHLY_COLUMNS = (
+    "shift_days", "closed_days", "vacation_days", "worked_minutes",
+    "entry_minutes", "exit_minutes", "overtime_days", "debt_days",
+)
+
+def _integer_daily_select(closed_filter):
+    return f"""
+    SELECT user_id, day, vacation_day, shift_day, closed_day,
+           CASE WHEN closed_day THEN worked_minutes END,
+           CASE WHEN closed_day THEN entry_ts % 86400 / 60 END,
+           CASE WHEN closed_day THEN exit_ts % 86400 / 60 END,
+           closed_day AND worked_minutes > {NORM_MINUTES},
+           closed_day AND worked_minutes < {NORM_MINUTES}
+    FROM (
+        SELECT user_id, date AS day, worked_minutes, entry_ts, exit_ts,
+               COALESCE(vacation, 0) != 0 AS vacation_day,
+               COALESCE(vacation, 0) = 0 AS shift_day,
+               COALESCE(vacation, 0) = 0 AND entry_ts IS NOT NULL AND exit_ts IS NOT NULL
+                   {closed_filter} AS closed_day
+        FROM records
+        WHERE {{where}}
+    )
+"""
+
+
+# Смена, закрытая ночной сверкой, выхода не имеет: в средние вход/выход не идёт
+DAILY_SELECT = _integer_daily_select("AND NOT auto_closed")
+
+# До миграции 5 у records нет целочисленных полей: время считается из текста
+_SECONDS = "(CAST(substr({0}, 1, 2) AS INTEGER) * 3600 + CAST(substr({0}, 4, 2) AS INTEGER) * 60" \
+           " + CAST(substr({0}, 7, 2) AS INTEGER))"
+
+TEXT_DAILY_SELECT = f"""
+    SELECT user_id, day, vacation_day, shift_day, closed_day,
+           CASE WHEN closed_day THEN (exit_s - entry_s) / 60 END,
+           CASE WHEN closed_day THEN entry_s / 60 END,
+           CASE WHEN closed_day THEN exit_s / 60 END,
+           closed_day AND (exit_s - entry_s) / 60 > {NORM_MINUTES},
+           closed_day AND (exit_s - entry_s) / 60 < {NORM_MINUTES}
+    FROM (
+        SELECT user_id, date AS day,
+               COALESCE(vacation, 0) != 0 AS vacation_day,
+               COALESCE(vacation, 0) = 0 AS shift_day,
+               COALESCE(vacation, 0) = 0 AND entry_time IS NOT NULL AND exit_time IS NOT NULL AS closed_day,
+               {_SECONDS.format("entry_time")} AS entry_s,
+               {_SECONDS.format("exit_time")} AS exit_s
+        FROM records
+        WHERE {{where}}
+    )
+"""
+
+_MONTHLY_SUMS = (
+    "SUM(shift_day)", "SUM(closed_day)", "SUM(vacation_day)", "COALESCE(SUM(worked_minutes), 0)",
+    "COALESCE(SUM(entry_minute), 0)", "COALESCE(SUM(exit_minute), 0)", "SUM(overtime_day)", "SUM(debt_day)",
+)
+
+
+def create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            vacation_day INTEGER NOT NULL,
+            shift_day INTEGER NOT NULL,
+            closed_day INTEGER NOT NULL,
+            worked_minutes INTEGER,
+            entry_minute INTEGER,
+            exit_minute INTEGER,
+            overtime_day INTEGER NOT NULL,
+            debt_day INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_stats (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            shift_days INTEGER NOT NULL DEFAULT 0,
+            closed_days INTEGER NOT NULL DEFAULT 0,
+            vacation_days INTEGER NOT NULL DEFAULT 0,
+            worked_minutes INTEGER NOT NULL DEFAULT 0,
+            entry_minutes INTEGER NOT NULL DEFAULT 0,
+            exit_minutes INTEGER NOT NULL DEFAULT 0,
+            overtime_days INTEGER NOT NULL DEFAULT 0,
+            debt_days INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    """)
+
+
+def _apply(conn, where, params, sign):
+    # Добавляем (sign=1) или вычитаем (sign=-1) вклад дневных строк в месячные
+    updates = ", ".join(f"{c} = {c} + excluded.{c}" for c in MONTHLY_COLUMNS)
+    conn.execute(f"""
+        INSERT INTO monthly_stats (user_id, month, {", ".join(MONTHLY_COLUMNS)})
+        SELECT user_id, substr(day, 1, 7), {", ".join(f"{sign} * {expr}" for expr in _MONTHLY_SUMS)}
+        FROM daily_stats
+        WHERE {where}
+        GROUP BY user_id, substr(day, 1, 7)
+        ON CONFLICT (user_id, month) DO UPDATE SET {updates}
+    """, params)
+
+
+def _recompute(conn, day_where, record_where, params):
+    _apply(conn, day_where, params, -1)
+    conn.execute(f"DELETE FROM daily_stats WHERE {day_where}", params)
+    conn.execute("INSERT INTO daily_stats " + DAILY_SELECT.format(where=record_where), params)
+    _apply(conn, day_where, params, 1)
+
+
+def refresh(conn, user_id, first_day, last_day=None):
+    """Пересчитывает сводки пользователя за дни first_day..last_day."""
+    last_day = last_day or first_day
+    _recompute(conn, "user_id = ? AND day BETWEEN ? AND ?", "user_id = ? AND date BETWEEN ? AND ?",
+               (user_id, first_day, last_day))
+
+
+def refresh_days(conn, table):
+    """Пересчитывает сводки за пары (user_id, day) из таблицы table — одним набором запросов."""
+    keys = f"IN (SELECT user_id, day FROM {table})"
+    _recompute(conn, f"(user_id, day) {keys}", f"(user_id, date) {keys}", ())
+
+
+def _hot(conn, column):
+    # Месяцы перенесённых в архив лет пересчитать не из чего — их не трогаем
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'archived_years'").fetchone():
+        return f"substr({column}, 1, 4) NOT IN (SELECT year FROM archived_years)"
+    return "1"
+
+
+def _daily_select(conn):
+    # rebuild вызывается и из миграций 4 и 5, когда entry_ts и auto_closed ещё нет
+    columns = {row[0] for row in conn.execute("SELECT name FROM pragma_table_info('records')")}
+    if "entry_ts" not in columns:
+        return TEXT_DAILY_SELECT
+    if "auto_closed" not in columns:
+        return _integer_daily_select("")
+    return DAILY_SELECT
+
+
+def rebuild(conn):
+    """Полный пересчёт сводок по records. Возвращает число расходившихся месячных строк."""
+    hot = _hot(conn, "month")
+    conn.execute("DROP TABLE IF EXISTS temp.monthly_check")
+    conn.execute(f"CREATE TEMP TABLE monthly_check AS SELECT * FROM monthly_stats WHERE {hot}")
+    conn.execute("DELETE FROM daily_stats")
+    conn.execute(f"DELETE FROM monthly_stats WHERE {hot}")
+    conn.execute("INSERT INTO daily_stats " + _daily_select(conn).format(where="user_id IS NOT NULL AND date IS NOT NULL"))
+    conn.execute(f"""
+        INSERT INTO monthly_stats (user_id, month, {", ".join(MONTHLY_COLUMNS)})
+        SELECT user_id, substr(day, 1, 7), {", ".join(_MONTHLY_SUMS)}
+        FROM daily_stats
+        WHERE {_hot(conn, "day")}
+        GROUP BY user_id, substr(day, 1, 7)
+    """)
+    # Нулевые месячные строки (остаются после вычитаний) считаем отсутствующими
+    old = "SELECT * FROM temp.monthly_check WHERE shift_days OR vacation_days"
+    new = f"SELECT * FROM monthly_stats WHERE {hot}"
+    mismatched = conn.execute(f"""
+        SELECT COUNT(*) FROM (
+            SELECT user_id, month FROM ({old} EXCEPT {new})
+            UNION
+            SELECT user_id, month FROM ({new} EXCEPT {old})
+        )
+    """).fetchone()[0]
+    conn.execute("DROP TABLE temp.monthly_check")
+    return mismatched
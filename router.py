@@ -0,0 +1,104 @@
+import asyncio
+import os
+import time
+
+from aiogram import types
+
+import metrics
+
+# Повтор того же текста от того же пользователя в этом окне считается двойным нажатием
+TAP_DEBOUNCE = float(os.getenv("TAP_DEBOUNCE_MS", "1500")) / 1000
+# Сколько отметок о недавних нажатиях держать до чистки просроченных
+RECENT_LIMIT = 10000
+
+coalesced_taps = metrics.Counter("wktb_coalesced_taps_total", "Отброшенные повторные нажатия", ("handler",))
+
+
+class TextRouter:
+    """Маршрутизация текстовых сообщений по кнопкам меню.
+
+    Точные тексты кнопок лежат в словаре и находятся одним поиском,
+    шаблоны (например, период отпуска) проверяются только если точного
+    совпадения нет. В Dispatcher регистрируется один обработчик.
+
+    Сообщения одного пользователя обрабатываются по очереди. Такой же
+    текст, пришедший, пока первый ещё обрабатывается или в течение
+    TAP_DEBOUNCE после него, отбрасывается: ответ на первое нажатие
+    уже отправлен или вот-вот будет.
+    """
+
+    def __init__(self, debounce=TAP_DEBOUNCE):
+        self.exact = {}
+        self.patterns = []
+        self.debounce = debounce
+        self._locks = {}
+        self._inflight = set()
+        self._recent = {}
+
+    def text(self, *texts):
+        def decorator(handler):
+            for text in texts:
+                if text in self.exact:
+                    raise ValueError(f"Кнопка {text!r} уже занята обработчиком {self.exact[text].__name__}")
+                self.exact[text] = handler
+            return handler
+        return decorator
+
+    def pattern(self, predicate):
+        def decorator(handler):
+            self.patterns.append((predicate, handler))
+            return handler
+        return decorator
+
+    def resolve(self, text):
+        handler = self.exact.get(text)
+        if handler is not None:
+            return handler
+        for predicate, handler in self.patterns:
+            if predicate(text):
+                return handler
+        return None
+
+    def _filter(self, message: types.Message):
+        handler = self.resolve(message.text)
+        if handler is None:
+            return False
+        return {"route": handler}
+
+    def _is_duplicate(self, key):
+        if key in self._inflight:
+            return True
+        until = self._recent.get(key)
+        return until is not None and until > time.monotonic()
+
+    def _remember(self, key):
+        now = time.monotonic()
+        if len(self._recent) >= RECENT_LIMIT:
+            self._recent = {k: until for k, until in self._recent.items() if until > now}
+        self._recent[key] = now + self.debounce
+
+    async def _dispatch(self, message: types.Message, route):
+        user_id = message.from_user.id
+        key = (user_id, message.text)
+        if self._is_duplicate(key):
+            coalesced_taps.inc(route.__name__)
+            return None
+
+        self._inflight.add(key)
+        # Замок живёт, пока его кто-то держит или ждёт
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await route(message)
+        finally:
+            self._inflight.discard(key)
+            self._remember(key)
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+    def setup(self, dp):
+        dp.register_message_handler(self._dispatch, self._filter, content_types=types.ContentTypes.TEXT)
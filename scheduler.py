@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+import metrics
+
+# Дольше не спим: часы сверяются заново, так что перевод времени
+# или сон машины не сдвигают запуск дальше чем на минуту
+MAX_SLEEP = 60
+
+job_seconds = metrics.Gauge("wktb_job_duration_seconds", "Длительность последнего запуска задачи", ("job",))
+job_errors = metrics.Counter("wktb_job_errors_total", "Ошибки фоновых задач", ("job",))
+job_timestamp = metrics.Gauge("wktb_job_last_run_timestamp", "Время последнего запуска задачи", ("job",))
+
+
+class Job:
+    """Фоновая задача: раз в сутки в заданное время."""
+
+    def __init__(self, name, fn, at):
+        self.name = name
+        self.fn = fn
+        self.at = at
+        self.next_run = None
+
+    def next_after(self, now):
+        # Ближайший плановый запуск строго позже now; пропущенные слоты не копятся
+        target = now.replace(hour=self.at[0], minute=self.at[1], second=0, microsecond=0)
+        return target if target > now else target + timedelta(days=1)
+
+    def last_due(self, now):
+        # Самый поздний плановый запуск не позже now
+        return self.next_after(now) - timedelta(days=1)
+
+
+class Scheduler:
+    """Запускает задачи по расписанию.
+
+    Время срабатывания считается от часов, а не от длительности сна,
+    поэтому запуски не уплывают. После успешного или упавшего запуска
+    в job_runs пишется плановое время слота: после перезапуска задача,
+    пропустившая слот, выполняется один раз сразу, а уже отработавшая
+    повторно не запускается.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.jobs = []
+
+    def daily(self, name, at):
+        hour, minute = map(int, at.split(":"))
+
+        def decorator(fn):
+            self.jobs.append(Job(name, fn, at=(hour, minute)))
+            return fn
+        return decorator
+
+    async def _plan(self):
+        runs = await self.storage.get_job_runs()
+        now = datetime.now()
+        for job in self.jobs:
+            last = runs.get(job.name)
+            if last is None:
+                job.next_run = job.next_after(now)
+            else:
+                last = datetime.fromisoformat(last)
+                job.next_run = job.next_after(last)
+                if job.next_run <= now:
+                    # Пропущенные за время простоя слоты сливаются в один запуск
+                    job.next_run = job.last_due(now)
+            logging.info(f"[Планировщик] {job.name}: следующий запуск {job.next_run:%d.%m.%Y %H:%M}")
+
+    async def _run(self, job):
+        slot = job.next_run
+        started = time.perf_counter()
+        try:
+            await job.fn()
+        except Exception:
+            job_errors.inc(job.name)
+            logging.exception(f"[Планировщик] Ошибка задачи {job.name}")
+        job_seconds.set(time.perf_counter() - started, job.name)
+        job_timestamp.set(int(time.time()), job.name)
+        job.next_run = job.next_after(datetime.now())
+        # Не сохранили — после перезапуска задача лишь выполнится ещё раз
+        try:
+            await self.storage.save_job_run(job.name, slot.isoformat(timespec="seconds"))
+        except Exception:
+            logging.exception(f"[Планировщик] Не удалось сохранить время запуска {job.name}")
+
+    async def run(self):
+        if not self.jobs:
+            return
+        while True:
+            try:
+                await self._plan()
+                break
+            except Exception:
+                logging.exception("[Планировщик] Не удалось прочитать время прошлых запусков")
+                await asyncio.sleep(MAX_SLEEP)
+        while True:
+            # Сбой одной итерации не должен останавливать все фоновые задачи
+            try:
+                now = datetime.now()
+                for job in self.jobs:
+                    if job.next_run <= now:
+                        await self._run(job)
+            except Exception:
+                logging.exception("[Планировщик] Ошибка цикла")
+            wake = min(job.next_run for job in self.jobs)
+            await asyncio.sleep(min(max((wake - datetime.now()).total_seconds(), 0), MAX_SLEEP))
@@ -0,0 +1,220 @@
+"""Хранилище данных бота: смены, отметки, отпуска, долг.
+
+Бэкенд выбирается переменной STORAGE_URL:
+
+    sqlite                    — файл DB_PATH (по умолчанию)
+    memory                    — всё в памяти процесса, для тестов и замеров
+    postgresql://user@host/db — PostgreSQL через asyncpg, общий для нескольких процессов
+"""
+import asyncio
+import os
+from datetime import datetime
+
+import db
+from db import MAX_SHIFT_HOURS, timestamp
+
+STORAGE_URL = os.getenv("STORAGE_URL", "sqlite")
+
+
+class Storage:
+    """Общий интерфейс хранилищ. Все методы — корутины.
+
+    Даты передаются и возвращаются строками ISO (YYYY-MM-DD), время
+    отметок — строками HH:MM:SS и «настенными» секундами (db.timestamp).
+    """
+
+    # Файл базы для бэкапа; у серверных БД бэкап делается их средствами
+    path = None
+    # Данные меняют и другие процессы: состояние в памяти процесса может устареть
+    shared = False
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # --- Смены ---
+
+    async def user_has_shift(self, user_id):
+        raise NotImplementedError
+
+    async def get_user_shift_time(self, user_id, target_date=None):
+        raise NotImplementedError
+
+    async def save_shift(self, user_id, start_time, effective_from):
+        raise NotImplementedError
+
+    # --- Отметки ---
+
+    async def add_entry(self, user_id, username, day, entry_time, entry_ts):
+        """Отмечает вход. False — вход за этот день уже был."""
+        raise NotImplementedError
+
+    async def get_open_record(self, user_id, now_ts=None):
+        """(day, entry_ts) открытой смены не старше MAX_SHIFT_HOURS или None."""
+        raise NotImplementedError
+
+    async def check_user_on_shift(self, user_id):
+        return await self.get_open_record(user_id) is not None
+
+    async def close_day(self, user_id, day, exit_time, exit_ts, overtime):
+        """Отмечает выход и в той же транзакции начисляет или гасит долг."""
+        raise NotImplementedError
+
+    async def close_stale_records(self, durations, now_ts=None):
+        """Закрывает забытые смены всех пользователей. Возвращает [(user_id, day, minutes долга)]."""
+        raise NotImplementedError
+
+    async def get_records_since(self, user_id, first_day):
+        """[(date, entry_time, exit_time, vacation, auto_closed)] по возрастанию даты."""
+        raise NotImplementedError
+
+    async def get_month_stats(self, user_id, month):
+        """Строка rollups.MONTHLY_COLUMNS за месяц YYYY-MM или None."""
+        raise NotImplementedError
+
+    # --- Отпуска ---
+
+    async def add_vacation(self, user_id, first_day, last_day):
+        """Возвращает (добавлено дней, пропущено дней с отметками)."""
+        raise NotImplementedError
+
+    # --- Долг ---
+
+    async def get_total_debt(self, user_id):
+        raise NotImplementedError
+
+    async def get_debt_by_day(self, user_id):
+        raise NotImplementedError
+
+    # --- Доступ ---
+
+    async def get_authorized_users(self):
+        raise NotImplementedError
+
+    async def add_authorized_users(self, user_ids):
+        """Возвращает число новых пользователей."""
+        raise NotImplementedError
+
+    async def remove_authorized_users(self, user_ids):
+        """Возвращает число удалённых пользователей."""
+        raise NotImplementedError
+
+    # --- Служебное ---
+
+    async def get_job_runs(self):
+        raise NotImplementedError
+
+    async def save_job_run(self, name, last_run):
+        raise NotImplementedError
+
+    async def export_attendance(self, user_ids, first_day, last_day, fmt="csv"):
+        raise RuntimeError("Выгрузка доступна только для SQLite")
+
+    async def archive_closed_years(self):
+        """Переносит закрытые годы из рабочих таблиц. Возвращает [(год, файл, отметок, записей долга)]."""
+        return []
+
+    async def compact(self):
+        """Возвращает место, освобождённое удалениями. Возвращает число страниц."""
+        return 0
+
+    async def rebuild_rollups(self):
+        raise RuntimeError("Сводки ведутся только в SQLite")
+
+
+class SQLiteStorage(Storage):
+    """Обёртка над db.py: файл DB_PATH, групповой коммит, кэш смен и сводки."""
+
+    path = db.DB_PATH
+
+    async def open(self):
+        await asyncio.get_running_loop().run_in_executor(None, db.init_db)
+
+    async def close(self):
+        await db.close_db()
+
+    async def user_has_shift(self, user_id):
+        return await db.user_has_shift(user_id)
+
+    async def get_user_shift_time(self, user_id, target_date=None):
+        return await db.get_user_shift_time(user_id, target_date)
+
+    async def save_shift(self, user_id, start_time, effective_from):
+        await db.save_shift(user_id, start_time, effective_from)
+
+    async def add_entry(self, user_id, username, day, entry_time, entry_ts):
+        return await db.add_entry(user_id, username, day, entry_time, entry_ts)
+
+    async def get_open_record(self, user_id, now_ts=None):
+        return await db.get_open_record(user_id, now_ts)
+
+    async def close_day(self, user_id, day, exit_time, exit_ts, overtime):
+        await db.close_day(user_id, day, exit_time, exit_ts, overtime)
+
+    async def close_stale_records(self, durations, now_ts=None):
+        return await db.close_stale_records(durations, now_ts)
+
+    async def get_records_since(self, user_id, first_day):
+        return await db.get_records_since(user_id, first_day)
+
+    async def get_month_stats(self, user_id, month):
+        return await db.get_month_stats(user_id, month)
+
+    async def add_vacation(self, user_id, first_day, last_day):
+        return await db.add_vacation(user_id, first_day, last_day)
+
+    async def get_total_debt(self, user_id):
+        return await db.get_total_debt(user_id)
+
+    async def get_debt_by_day(self, user_id):
+        return await db.get_debt_by_day(user_id)
+
+    async def get_authorized_users(self):
+        return await db.get_authorized_users()
+
+    async def add_authorized_users(self, user_ids):
+        return await db.add_authorized_users(user_ids)
+
+    async def remove_authorized_users(self, user_ids):
+        return await db.remove_authorized_users(user_ids)
+
+    async def get_job_runs(self):
+        return await db.get_job_runs()
+
+    async def save_job_run(self, name, last_run):
+        await db.save_job_run(name, last_run)
+
+    async def export_attendance(self, user_ids, first_day, last_day, fmt="csv"):
+        return await db.export_attendance(user_ids, first_day, last_day, fmt)
+
+    async def archive_closed_years(self):
+        return await db.archive_closed_years()
+
+    async def compact(self):
+        return await db.compact()
+
+    async def rebuild_rollups(self):
+        return await db.rebuild_rollups()
+
+
+def open_storage(url=None):
+    url = url or STORAGE_URL
+    if url == "sqlite":
+        return SQLiteStorage()
+    if url == "memory":
+        from memstorage import MemoryStorage
+        return MemoryStorage()
+    if url.startswith(("postgresql://", "postgres://")):
+        from pgstorage import PostgresStorage
+        return PostgresStorage(url)
+    raise ValueError(f"Неизвестное хранилище STORAGE_URL={url!r}")
+
+
+def open_cutoff(now_ts=None):
+    # Общие для бэкендов границы открытой смены: (now_ts, вчера, самый ранний вход)
+    if now_ts is None:
+        now_ts = timestamp(datetime.now())
+    yesterday = datetime.utcfromtimestamp(now_ts - 86400).date().isoformat()
+    return now_ts, yesterday, now_ts - MAX_SHIFT_HOURS * 3600
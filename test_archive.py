@@ -0,0 +1,108 @@
+"""Перенос закрытого года в архив: выгрузка через records_all и долг не меняются.
+
+    python -m pytest -q test_archive.py
+"""
+import os
+import sqlite3
+import tempfile
+from datetime import date, datetime, timedelta
+
+# db читает DB_PATH при импорте: рабочую базу не трогаем
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="wktb-test-"), "test.sqlite"))
+
+import archive  # noqa: E402
+import backup  # noqa: E402
+import db  # noqa: E402
+import export  # noqa: E402
+import rollups  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+USERS = (21, 22)
+NORM_MINUTES = 420
+# (день, пользователь, вход, минут на смене); None — отпуск
+DAYS = (
+    ("2023-12-04", 21, "09:00", 300),  # долг 120
+    ("2023-12-05", 21, "09:00", 540),  # долг погашен
+    ("2023-12-06", 21, "09:00", 360),  # долг 60, до конца года не погашен
+    ("2023-12-04", 22, "08:00", 420),
+    ("2023-12-05", 22, "08:00", 500),
+    ("2023-12-11", 22, None, None),
+    ("2024-01-09", 21, "09:00", 400),  # долг 20 за следующий год
+    ("2024-01-09", 22, "08:00", 300),  # долг 120
+)
+
+
+def _fill(conn):
+    for day, user_id, entry_time, minutes in DAYS:
+        with conn:
+            if entry_time is None:
+                db._add_vacation(conn, user_id, day, day)
+                continue
+            entry = datetime.fromisoformat(f"{day}T{entry_time}")
+            exit_ = entry + timedelta(minutes=minutes)
+            db._add_entry(conn, user_id, f"user{user_id}", day, entry.strftime("%H:%M:%S"), db.timestamp(entry))
+            db._close_day(conn, user_id, day, exit_.strftime("%H:%M:%S"), db.timestamp(exit_),
+                          minutes - NORM_MINUTES)
+
+
+def _exported(conn, first_day, last_day):
+    path, count = export.export_attendance(conn, USERS, first_day, last_day)
+    try:
+        with open(path, encoding="utf-8-sig") as f:
+            return f.read(), count
+    finally:
+        os.remove(path)
+
+
+def _debts(conn):
+    return [
+        (
+            conn.execute("SELECT accrued - paid FROM debt_balance WHERE user_id = ?", (user_id,)).fetchone(),
+            conn.execute("SELECT day, minutes FROM debt WHERE user_id = ? ORDER BY day", (user_id,)).fetchall(),
+        )
+        for user_id in USERS
+    ]
+
+
+def test_archived_year_exports_and_keeps_debt():
+    work = tempfile.mkdtemp(prefix="wktb-archive-")
+    conn = sqlite3.connect(os.path.join(work, "data.sqlite"), uri=True)
+    try:
+        migrate(conn)
+        _fill(conn)
+        archive.attach(conn, [])
+        before_export = _exported(conn, "2023-01-01", "2024-12-31")
+        before_debts = _debts(conn)
+
+        years = archive.closed_years(conn, today=date(2024, 3, 1))
+        assert years == ["2023"]
+        moved, settled = archive.archive_year(conn, os.path.join(work, "archive"), "2023")
+        assert moved == 6
+        # Погашенные начисление и погашение; непогашенный долг за 06.12 остаётся
+        assert settled == 2
+
+        assert conn.execute("SELECT COUNT(*) FROM records WHERE date < '2024-01-01'").fetchone()[0] == 0
+        assert conn.execute("SELECT day FROM debt_ledger WHERE day < '2024-01-01'").fetchall() == [("2023-12-06",)]
+
+        archive.attach(conn, archive.archived(conn))
+        assert _exported(conn, "2023-01-01", "2024-12-31") == before_export
+        assert _debts(conn) == before_debts
+        # Сводки прошлых лет остались, пересчёт не трогает их и не расходится
+        assert rollups.rebuild(conn) == 0
+    finally:
+        conn.close()
+
+
+def test_archive_copy_survives_rotation():
+    work = tempfile.mkdtemp(prefix="wktb-archive-")
+    source = os.path.join(work, "records-2023.sqlite")
+    sqlite3.connect(source).close()
+    backups = os.path.join(work, "backups")
+
+    copy = backup.make_backup(source, backups, "gzip", datetime(2024, 3, 1),
+                              backup.ARCHIVE_NAME_FORMAT.format(year=2023))
+    for day in range(2, 40):
+        backup.make_backup(source, backups, "gzip", datetime(2024, 3, 1) + timedelta(days=day))
+
+    assert os.path.basename(copy.path) == "records-2023-20240301-000000.sqlite.gz"
+    assert os.path.exists(copy.path)
@@ -0,0 +1,139 @@
+"""Сверка хранилищ: один и тот же случайный сценарий на MemoryStorage и на
+бэкенде из STORAGE_URL (по умолчанию SQLite во временном файле).
+
+    python -m pytest -q test_storage.py
+    STORAGE_URL=postgresql://user@host/test_db python -m pytest -q test_storage.py
+
+Таблицы PostgreSQL перед прогоном очищаются — указывайте отдельную базу.
+Прогон на PostgreSQL 16.2 (TEST_SEED по умолчанию и 1–30) расхождений не дал.
+"""
+import asyncio
+import os
+import random
+import tempfile
+from datetime import date, datetime, time, timedelta
+
+# SQLite-бэкенд читает DB_PATH при импорте db: рабочую базу не трогаем
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="wktb-test-"), "test.sqlite")
+
+from db import timestamp  # noqa: E402
+from memstorage import MemoryStorage  # noqa: E402
+from storage import STORAGE_URL, open_storage  # noqa: E402
+
+SEED = int(os.getenv("TEST_SEED", "20250301"))
+DAYS = 45
+USERS = (11, 12, 13, 14, 15)
+SHIFT_STARTS = ("08:00", "14:00", "20:00")
+DURATIONS = {start: 420 for start in SHIFT_STARTS}
+NORM_MINUTES = 420
+FIRST_DAY = date(2025, 3, 1)
+
+PG_TABLES = "shifts, records, debt_ledger, debt_balance, authorized_users, job_runs"
+
+
+def _plain(value):
+    # asyncpg.Record, sqlite3.Row, списки и кортежи сравниваем как кортежи
+    if isinstance(value, (str, bytes)) or not hasattr(value, "__iter__"):
+        return value
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    return tuple(_plain(item) for item in value)
+
+
+class Pair:
+    """Вызывает метод на обоих хранилищах и сравнивает результаты."""
+
+    def __init__(self, reference, subject):
+        self.reference = reference
+        self.subject = subject
+        self.calls = 0
+
+    async def __call__(self, method, *args, key=None):
+        expected = await getattr(self.reference, method)(*args)
+        actual = await getattr(self.subject, method)(*args)
+        if key is not None:
+            expected, actual = key(expected), key(actual)
+        self.calls += 1
+        assert _plain(actual) == _plain(expected), f"{method}{args}: {actual!r} != {expected!r}"
+        return expected
+
+
+async def _reset(storage):
+    if getattr(storage, "pool", None) is not None:
+        await storage.pool.execute(f"TRUNCATE {PG_TABLES}")
+
+
+async def _day(call, rng, day):
+    iso = day.isoformat()
+    for user_id in USERS:
+        if rng.random() < 0.1 or day == FIRST_DAY:
+            await call("save_shift", user_id, rng.choice(SHIFT_STARTS), iso)
+        if rng.random() < 0.05:
+            last = day + timedelta(days=rng.randrange(3))
+            await call("add_vacation", user_id, iso, last.isoformat())
+            continue
+        if rng.random() > 0.75:
+            continue
+
+        entry = datetime.combine(day, time(6)) + timedelta(seconds=rng.randrange(15 * 3600))
+        entry_ts = timestamp(entry)
+        await call("add_entry", user_id, f"user{user_id}", iso, entry.strftime("%H:%M:%S"), entry_ts)
+        if rng.random() < 0.1:
+            # Повторное нажатие «Я на предприятии»
+            await call("add_entry", user_id, f"user{user_id}", iso, entry.strftime("%H:%M:%S"), entry_ts + 60)
+        if rng.random() < 0.2:
+            continue  # выход забыт — закроет ночная сверка
+
+        exit_ = entry + timedelta(minutes=rng.randrange(300, 660))
+        exit_ts = timestamp(exit_)
+        found = await call("get_open_record", user_id, exit_ts)
+        if found is not None:
+            worked = (exit_ts - found[1]) // 60
+            await call("close_day", user_id, found[0], exit_.strftime("%H:%M:%S"), exit_ts, worked - NORM_MINUTES)
+
+
+async def _check_user(call, user_id, day):
+    iso = day.isoformat()
+    await call("user_has_shift", user_id)
+    await call("get_user_shift_time", user_id, iso)
+    await call("get_total_debt", user_id)
+    await call("get_debt_by_day", user_id)
+    await call("get_month_stats", user_id, iso[:7])
+    await call("get_records_since", user_id, day.replace(day=1).isoformat())
+
+
+async def run_scenario(subject, seed=SEED):
+    reference = MemoryStorage()
+    await subject.open()
+    try:
+        await _reset(subject)
+        call = Pair(reference, subject)
+        rng = random.Random(seed)
+
+        await call("add_authorized_users", list(USERS[:3]))
+        await call("add_authorized_users", list(USERS[1:]))
+        await call("remove_authorized_users", [USERS[0], 999])
+        await call("get_authorized_users", key=sorted)
+
+        for offset in range(DAYS):
+            day = FIRST_DAY + timedelta(days=offset)
+            await _day(call, rng, day)
+            night = timestamp(datetime.combine(day + timedelta(days=1), time(4)))
+            await call("close_stale_records", DURATIONS, night, key=sorted)
+            await call("save_job_run", "reconcile", f"{day + timedelta(days=1)}T04:00:00")
+            for user_id in USERS:
+                await _check_user(call, user_id, day)
+
+        await call("get_job_runs")
+        return call.calls
+    finally:
+        await subject.close()
+
+
+def test_storage_matches_memory():
+    calls = asyncio.run(run_scenario(open_storage()))
+    assert calls > DAYS * len(USERS)
+
+
+if __name__ == "__main__":
+    print(f"{STORAGE_URL}: совпало вызовов {asyncio.run(run_scenario(open_storage()))}")
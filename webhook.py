@@ -0,0 +1,73 @@
+import hmac
+import logging
+import os
+
+from aiohttp import web
+from aiogram.utils import executor
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес бота, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Без WEBHOOK_URL сервер нужен только для локальной проверки — наружу не открываем
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0" if WEBHOOK_URL else "127.0.0.1")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", os.getenv("PORT", "8080")))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def secret_middleware(secret):
+    # Telegram присылает secret_token из setWebhook в заголовке каждого запроса
+    @web.middleware
+    async def middleware(request, handler):
+        if secret and request.path == WEBHOOK_PATH:
+            token = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(token, secret):
+                logging.warning(f"[Webhook] Запрос без верного секрета от {request.remote}")
+                raise web.HTTPForbidden()
+        return await handler(request)
+    return middleware
+
+
+def make_app():
+    return web.Application(middlewares=[secret_middleware(WEBHOOK_SECRET)])
+
+
+async def set_webhook(dispatcher):
+    # Без WEBHOOK_URL сервер просто принимает POST с Update — удобно для локальной проверки
+    if not WEBHOOK_URL:
+        logging.info(f"[Webhook] WEBHOOK_URL не задан, жду обновления на {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+        return
+    await dispatcher.bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        drop_pending_updates=True,
+    )
+    logging.info(f"[Webhook] Установлен {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+
+async def delete_webhook(dispatcher):
+    if WEBHOOK_URL:
+        await dispatcher.bot.delete_webhook()
+
+
+def start_webhook(dp, on_startup, on_shutdown):
+    # Без секрета любой, кто достучится до порта, пришлёт Update от имени владельца
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("Для webhook с WEBHOOK_URL задайте WEBHOOK_SECRET")
+
+    async def startup(dispatcher):
+        await set_webhook(dispatcher)
+        await on_startup(dispatcher)
+
+    async def shutdown(dispatcher):
+        await on_shutdown(dispatcher)
+        await delete_webhook(dispatcher)
+
+    runner = executor.set_webhook(
+        dp,
+        WEBHOOK_PATH,
+        on_startup=startup,
+        on_shutdown=shutdown,
+        web_app=make_app(),
+    )
+    runner.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)